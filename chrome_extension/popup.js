@@ -14,7 +14,7 @@ function fetchTconst(){
       if(!tconst.includes('tt')){
         throw 'not a valid tconst'
       }
-      getBaseMovie(tconst)
+      getMovieAndSimilar(tconst)
     }
     catch{
       show_error()
@@ -22,28 +22,24 @@ function fetchTconst(){
   });
 }
 
-//get the base movie info
-function getBaseMovie(tconst){
+//get the base movie info and its similar movies in a single request,
+//asking only for the fields we actually display
+function getMovieAndSimilar(tconst){
   const http = new XMLHttpRequest();
-  const url=`${baseurl}/movie?tconst=${tconst}`;
-  http.open("GET", url);
-  http.send();
-  http.onreadystatechange=(e)=>{
-    const obj = JSON.parse(http.responseText)
-    document.getElementById("BaseMovie").innerText = obj.title;
-    getSimilarMovie(tconst)
-  } 
-}
-
-//get the similar movie info
-function getSimilarMovie(tconst){
-  const http = new XMLHttpRequest();
-  const url=`${baseurl}/similar?tconst=${tconst}&limit=20`;
+  const url=`${baseurl}/movie_and_similar?tconst=${tconst}&limit=20&fields=tconst,title,poster,rating`;
   http.open("GET", url);
   http.send();
   http.onreadystatechange=(e)=>{
+    if(http.readyState !== XMLHttpRequest.DONE){
+      return
+    }
+    if(http.status !== 200){
+      show_error()
+      return
+    }
     const obj = JSON.parse(http.responseText)
-    buildMovieTable(obj.all)
+    document.getElementById("BaseMovie").innerText = obj.movie.title;
+    buildMovieTable(obj.similar.all)
   }
 }
 
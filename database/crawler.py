@@ -0,0 +1,173 @@
+import threading, time, email.utils, requests, backoff
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# Shared plumbing for the scripts in this folder that crawl HTTP services: thread pool
+# stages with their own concurrency and rate limits, pooled keep-alive sessions, and
+# retries with exponential backoff.
+
+USER_AGENT = (
+    "CS410CourseProject/1.0 (https://github.com/VAkarsh20/CS410CourseProject) "
+    f"python-requests/{requests.__version__}"
+)
+
+# Status codes that are worth retrying: rate limiting and transient server errors.
+# Any other HTTP error (e.g. 404) fails straight away.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Longest wait between two attempts of a request, in seconds
+MAX_BACKOFF = 60
+
+
+# A token bucket that lets through rate calls per second on average, and bursts of up to
+# burst calls. Calls that exceed the rate reserve a token ahead of time and sleep until
+# it is due, so waiting callers are served in order. A rate of None disables the limit.
+# Every call can also be held back for a while with pause, e.g. when a service asks us to
+# slow down.
+class RateLimiter:
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._resume = 0
+        self._lock = threading.Lock()
+
+    # Blocks until the next call is allowed
+    def acquire(self):
+        if self.rate is not None:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                self._tokens -= 1
+                wait = -self._tokens / self.rate
+
+            if wait > 0:
+                time.sleep(wait)
+
+        # Wait out any pause, including one that started while we were waiting
+        while True:
+            with self._lock:
+                wait = self._resume - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+
+    # Holds back every call for the next seconds
+    def pause(self, seconds):
+        with self._lock:
+            self._resume = max(self._resume, time.monotonic() + seconds)
+
+
+# Returns a requests session that keeps up to pool_size connections per host alive
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+# Returns how many seconds a response's Retry-After header asks us to wait (given either
+# in seconds or as a date), or None if it doesn't have a valid one
+def retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, date.timestamp() - time.time())
+
+
+# Returns whether a failed request shouldn't be retried
+def _is_permanent(e):
+    response = getattr(e, "response", None)
+    return response is not None and response.status_code not in RETRY_STATUSES
+
+
+# A stage of a crawl: a pool of concurrency threads that share a keep-alive session and a
+# rate limit (requests per second, None for no limit). Calls submitted to a stage are
+# retried with exponential backoff, up to max_tries attempts in total, if any request they
+# make fails with a connection error, a timeout, or one of RETRY_STATUSES. When a service
+# answers 429 with a Retry-After header, every request of the stage waits that long.
+class Stage:
+    def __init__(self, name, concurrency, rate=None, max_tries=5, timeout=60):
+        self.name = name
+        self.timeout = timeout
+        self.session = make_session(concurrency)
+        self.limiter = RateLimiter(rate)
+        self.retries = 0
+        self.throttled = 0
+        self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix=name)
+        self._call = backoff.on_exception(
+            backoff.expo,
+            requests.RequestException,
+            max_tries=max_tries,
+            max_value=MAX_BACKOFF,
+            giveup=_is_permanent,
+            on_backoff=self._count_retry,
+            logger=None,
+        )(self._attempt)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Schedules fn(stage, *args) on the stage's threads, and returns its future
+    def submit(self, fn, *args):
+        return self._executor.submit(self._call, fn, *args)
+
+    # Makes a single request within the stage's rate limit, and raises an HTTPError for
+    # error responses
+    def request(self, method, url, **kwargs):
+        self.limiter.acquire()
+        response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        if response.status_code == 429:
+            self.throttled += 1
+            delay = retry_after(response)
+            if delay is not None:
+                self.limiter.pause(delay)
+        response.raise_for_status()
+        return response
+
+    # Waits for every submitted call to finish, and closes the session
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def _attempt(self, fn, *args):
+        return fn(self, *args)
+
+    def _count_retry(self, details):
+        self.retries += 1
+
+
+# A batch size that adapts to how much a service can handle per request: it halves
+# whenever a batch fails for being too large, and grows back by an eighth after every
+# success, up to max_size
+class AdaptiveBatchSize:
+    def __init__(self, max_size, min_size=1):
+        self.max_size = max_size
+        self.min_size = min_size
+        self.size = max_size
+        self._lock = threading.Lock()
+
+    # Records that a batch of failed_size items was too large
+    def shrink(self, failed_size):
+        with self._lock:
+            self.size = max(self.min_size, min(self.size, failed_size // 2))
+
+    # Records that a batch succeeded
+    def grow(self):
+        with self._lock:
+            self.size = min(self.max_size, self.size + max(1, self.size // 8))
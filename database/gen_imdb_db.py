@@ -1,119 +1,266 @@
-import os, wget, gzip, shutil, sqlite3, glob, tqdm, requests, backoff, urllib, pickle
+import os, sys, sqlite3, glob, tempfile, time, tqdm, requests, json, concurrent.futures
 import pandas as pd
+from crawler import Stage
+from journal import Journal
 
 """
-This script generates a file imdb.db with the following two tables, keyed by IMDB IDs:
+This script generates a file imdb.db with the following three tables, keyed by IMDB IDs:
 - titles: List of IMDB movies 
 - names: List of IMDB-registered people (actors, directors, etc)
+- movies_serving: The movies in titles, with the names of their directors/writers
 
 Usage: python gen_imdb_db.py
 """
 
-# Downloads/extracts appropiate IMDB files
-def download_files():
-    LINKS = {
-        "names.tsv": "https://datasets.imdbws.com/name.basics.tsv.gz",
-        "akas.tsv": "https://datasets.imdbws.com/title.akas.tsv.gz",
-        "basics.tsv": "https://datasets.imdbws.com/title.basics.tsv.gz",
-        "crew.tsv": "https://datasets.imdbws.com/title.crew.tsv.gz",
-        "principals.tsv": "https://datasets.imdbws.com/title.principals.tsv.gz",
-        "ratings.tsv": "https://datasets.imdbws.com/title.ratings.tsv.gz",
-    }
-
-    # Deletes all existing downloads
-    def delete_downloads():
-        files = list(glob.glob("*.tsv.gz"))
-        files.extend(list(glob.glob("*.tmp")))
-        for file in files:
-            os.remove(file)
-
-    delete_downloads()
-    for tsvname, link in LINKS.items():
-        # Download the file
-        print(f"\nDownloading {tsvname} from {link}")
-        archivename = wget.download(link)
-
-        # Extract the file
-        print(f"\nExtracting {archivename} to {tsvname}")
-        with gzip.open(archivename, "rb") as archive:
-            with open(tsvname, "wb") as tsv:
-                shutil.copyfileobj(archive, tsv)
-
-    delete_downloads()
-
-
-# Loads data from TSV files and produces two dataframes with movie and name data respectively
+# Number of rows read from a TSV file at a time
+TSV_CHUNK_SIZE = 500_000
+
+# Regions whose titles we keep
+REGIONS = {"US", "XNA", "XWW"}
+
+# Whether to only keep the people in names who directed or wrote one of the movies in
+# titles (which is all the server needs), rather than everyone in IMDB
+SLIM_DB = True
+
+# Schema of the movies_serving table: every column of titles, plus the names of the
+# directors/writers of each movie as JSON lists, so the server can look up a movie with a
+# single read by primary key
+SERVING_SCHEMA = """
+CREATE TABLE movies_serving (
+  tconst TEXT PRIMARY KEY,
+  title TEXT,
+  adult TEXT,
+  year INTEGER,
+  runtime INTEGER,
+  genres TEXT,
+  region TEXT,
+  directors TEXT,
+  directorNames TEXT,
+  writers TEXT,
+  writerNames TEXT,
+  rating REAL,
+  ratingVotes INTEGER,
+  poster TEXT
+) WITHOUT ROWID
+"""
+
+# IMDB's datasets (https://www.imdb.com/interfaces/), by the name of their local copy. The
+# archives are kept compressed, and read straight from the gzip stream.
+IMDB_DATASETS_URL = "https://datasets.imdbws.com"
+DATASETS = {
+    "names.tsv.gz": "name.basics.tsv.gz",
+    "akas.tsv.gz": "title.akas.tsv.gz",
+    "basics.tsv.gz": "title.basics.tsv.gz",
+    "crew.tsv.gz": "title.crew.tsv.gz",
+    "principals.tsv.gz": "title.principals.tsv.gz",
+    "ratings.tsv.gz": "title.ratings.tsv.gz",
+}
+
+# Size of the blocks that downloads are written to disk in, in bytes
+DOWNLOAD_BLOCK_SIZE = 1 << 20
+
+# TMDB's API, and where the posters it refers to are served from
+TMDB_API_URL = "https://api.themoviedb.org/3"
+TMDB_ROOT_POSTER_URL = "https://image.tmdb.org/t/p/w200"
+DEFAULT_POSTER_URL = (
+    "https://i.pinimg.com/736x/b6/01/18/b6011825cf909d54d93145b53bdb0bfb.jpg"
+)
+
+# Parallel requests and rate limit (requests per second) for TMDB's API. TMDB allows
+# around 50 requests per second per IP, and answers 429 when we go over.
+TMDB_STAGE = {"concurrency": 16, "rate": 40}
+
+# Downloads the IMDB datasets in DATASETS in parallel, unless the copy on disk is still up
+# to date. Every archive is kept after it is downloaded, together with the ETag and
+# Last-Modified headers it was served with (in the "downloads" table of the crawl journal),
+# so the next run only downloads the archives that changed since. Archives are downloaded
+# to a temporary file first, and never decompressed to disk. Returns how many archives
+# were downloaded and how many were already up to date.
+def download_files(datasets_url=IMDB_DATASETS_URL):
+
+    # Delete interrupted downloads
+    for file in glob.glob("*.tsv.gz.tmp"):
+        os.remove(file)
+
+    print("\nDownloading IMDB datasets...")
+    stats = {"downloaded": 0, "unchanged": 0}
+    progress = tqdm.tqdm(unit="B", unit_scale=True, unit_divisor=1024)
+    with Journal() as journal:
+        validators = journal.table("downloads")
+        with Stage("downloads", concurrency=len(DATASETS)) as stage:
+            futures = {}
+            for filename, remote_name in DATASETS.items():
+                url = f"{datasets_url}/{remote_name}"
+                validator = None
+                if os.path.exists(filename):
+                    validator = validators.get(filename)
+                future = stage.submit(download_file, url, filename, validator, progress)
+                futures[future] = filename
+
+            # Record each download as soon as it is in place, so that one failure doesn't
+            # lose the validators of the files that were already replaced
+            error = None
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    error = error or future.exception()
+                elif future.result() is None:
+                    stats["unchanged"] += 1
+                else:
+                    validators[futures[future]] = future.result()
+                    stats["downloaded"] += 1
+
+    progress.close()
+    if error is not None:
+        raise error
+    print(f"{stats['downloaded']} downloaded, {stats['unchanged']} already up to date")
+    return stats
+
+
+# Downloads url to filename, unless validator (the JSON-encoded ETag/Last-Modified headers
+# of the copy already at filename) shows that it hasn't changed. Returns the validator of
+# the new copy, or None if the copy on disk is still up to date.
+def download_file(stage, url, filename, validator=None, progress=None):
+    # Ask for the raw archive, so that it isn't decompressed on the fly
+    headers = {"Accept-Encoding": "identity"}
+    if validator is not None:
+        validator = json.loads(validator)
+        if "ETag" in validator:
+            headers["If-None-Match"] = validator["ETag"]
+        if "Last-Modified" in validator:
+            headers["If-Modified-Since"] = validator["Last-Modified"]
+
+    with stage.request("GET", url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return None
+        with open(f"{filename}.tmp", "wb") as f:
+            for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                f.write(block)
+                if progress is not None:
+                    progress.update(len(block))
+
+    os.replace(f"{filename}.tmp", filename)
+    return json.dumps(
+        {
+            name: response.headers[name]
+            for name in ("ETag", "Last-Modified")
+            if name in response.headers
+        }
+    )
+
+
+# Loads data from the IMDB archives and produces a dataframe with movie data, and an
+# iterator over dataframes with name data. Every file is read in chunks of TSV_CHUNK_SIZE
+# rows, with just the columns we need, and each chunk is filtered down to the rows we keep
+# before the next one is read, so only the filtered data is ever held in memory at once.
+# Values are parsed exactly like pandas would parse the whole file (e.g. "NA" is still
+# missing), so the resulting tables are the same.
 def load_data():
 
+    # Reads the given columns of a gzipped TSV file one chunk at a time, decompressing it
+    # as it goes. Columns are parsed as strings unless a dtype is given, and "\N" only
+    # means a missing value in na_columns.
+    def read_chunks(path, usecols, dtype=None, na_columns=()):
+        dtype = dtype or {}
+        return pd.read_csv(
+            path,
+            sep="\t",
+            usecols=usecols,
+            dtype={column: dtype.get(column, str) for column in usecols},
+            na_values={column: "\\N" for column in na_columns},
+            chunksize=TSV_CHUNK_SIZE,
+        )
+
     # Titles
     def get_titles():
-        titles = pd.read_csv("basics.tsv", sep="\t", low_memory=False)
-        titles = titles.set_index("tconst")
-        titles = titles[titles.titleType == "movie"]
+        columns = ["primaryTitle", "isAdult", "startYear", "runtimeMinutes", "genres"]
+        chunks = []
+        for chunk in read_chunks(
+            "basics.tsv.gz",
+            ["tconst", "titleType", *columns],
+            dtype={"titleType": "category"},
+            na_columns=["startYear", "runtimeMinutes"],
+        ):
+            chunk = chunk[chunk.titleType == "movie"]
+            years = pd.to_numeric(chunk.startYear)
+            chunk = chunk[years > 1990]
+            runtimes = pd.to_numeric(chunk.runtimeMinutes)
+            chunk = chunk[runtimes > 45]
+            chunks.append(chunk.set_index("tconst")[columns])
+
+        titles = pd.concat(chunks)
         titles = titles.replace(to_replace="\\N", value="0")
-        titles.startYear = pd.to_numeric(titles.startYear)
-        titles = titles[titles.startYear > 1990]
-        titles.runtimeMinutes = pd.to_numeric(titles.runtimeMinutes)
-        titles = titles[titles.runtimeMinutes > 45]
-        titles = titles[
-            ["primaryTitle", "isAdult", "startYear", "runtimeMinutes", "genres"]
-        ]
+        titles.startYear = pd.to_numeric(titles.startYear).astype("int16")
+        titles.runtimeMinutes = pd.to_numeric(titles.runtimeMinutes).astype("int32")
         titles.columns = ["title", "adult", "year", "runtime", "genres"]
 
         return titles
 
-    # Ratings
-    def get_ratings():
-        # Ratings
-        ratings = pd.read_csv("ratings.tsv", sep="\t", low_memory=False)
-        ratings = ratings.set_index("tconst")
+    # Ratings of the given titles
+    def get_ratings(tconsts):
+        chunks = []
+        for chunk in read_chunks(
+            "ratings.tsv.gz",
+            ["tconst", "averageRating", "numVotes"],
+            dtype={"averageRating": "float64", "numVotes": "int32"},
+        ):
+            chunks.append(chunk[chunk.tconst.isin(tconsts)].set_index("tconst"))
+
+        ratings = pd.concat(chunks)
         ratings.columns = ["rating", "ratingVotes"]
 
         return ratings
 
-    # Akas
-    def get_akas():
-        akas = pd.read_csv("akas.tsv", sep="\t", low_memory=False)
-        akas = akas.set_index("titleId")
+    # Regions of the given titles, from the first of their akas in one of REGIONS
+    def get_akas(tconsts):
+        chunks = []
+        for chunk in read_chunks(
+            "akas.tsv.gz", ["titleId", "region"], dtype={"region": "category"}
+        ):
+            chunk = chunk[chunk.region.isin(REGIONS) & chunk.titleId.isin(tconsts)]
+            chunks.append(chunk.astype({"region": str}))
+
+        akas = pd.concat(chunks).set_index("titleId")
         akas.index.name = "tconst"
-        akas = akas[akas.region.isin({"US", "XNA", "XWW"})]
         akas = akas[~akas.index.duplicated(keep="first")]
-        akas = akas.replace(to_replace="\\N", value="")
-        akas = akas[["title", "region", "language", "types"]]
 
         return akas
 
-    # Crew
-    def get_crew():
-        crew = pd.read_csv("crew.tsv", sep="\t", low_memory=False).set_index("tconst")
+    # Crew of the given titles
+    def get_crew(tconsts):
+        chunks = []
+        for chunk in read_chunks("crew.tsv.gz", ["tconst", "directors", "writers"]):
+            chunks.append(chunk[chunk.tconst.isin(tconsts)].set_index("tconst"))
+
+        crew = pd.concat(chunks)
         crew = crew.replace(to_replace="\\N", value="")
 
         return crew
 
-    # Names
+    # Names, one chunk at a time
     def get_names():
-        # Names
-        names = pd.read_csv("names.tsv", sep="\t", low_memory=False).set_index("nconst")
-        names.columns = ["name", "birthYear", "deathYear", "profession", "titles"]
-
-        return names
+        columns = ["nconst", "primaryName", "birthYear", "deathYear"]
+        columns += ["primaryProfession", "knownForTitles"]
+        for chunk in read_chunks("names.tsv.gz", columns):
+            names = chunk.set_index("nconst")
+            names.columns = ["name", "birthYear", "deathYear", "profession", "titles"]
+            yield names
 
     # Principals
     def get_principals():
         # Principals
-        principals = pd.read_csv("principals.tsv", sep="\t", low_memory=False)
+        principals = pd.read_csv("principals.tsv.gz", sep="\t", low_memory=False)
         principals = principals.replace(to_replace="\\N", value="")
 
         return principals
 
-    # Load and merge datasets
-    print("\nLoading data files into memory...")
-    titles, akas, crew, ratings, names = (
-        get_titles(),
-        get_akas(),
-        get_crew(),
-        get_ratings(),
-        get_names(),
+    # Load and merge datasets. Akas, crew, and ratings only keep the titles that are left
+    # after filtering, and names are only read when they are written to the database.
+    print("\nLoading data files...")
+    titles = get_titles()
+    akas, crew, ratings = (
+        get_akas(titles.index),
+        get_crew(titles.index),
+        get_ratings(titles.index),
     )
 
     print("\nBuilding dataframes...")
@@ -130,71 +277,83 @@ def load_data():
     # Merge with ratings
     titles = titles.merge(ratings, left_index=True, right_index=True, how="inner")
 
-    return titles, names
-
+    return titles, get_names()
+
+
+# Fetches the poster URL of every title in the dataframe from TMDB, and returns a copy of
+# it with a poster column. Titles are fetched concurrently on a stage (see TMDB_STAGE)
+# that reuses keep-alive connections, stays within TMDB's rate limit, and backs off when
+# TMDB asks it to. Titles whose poster couldn't be fetched are left without one, and are
+# fetched again the next time the script is run.
+def fetch_posters(titles, api_key, api_url=TMDB_API_URL, stage_options=TMDB_STAGE):
+    # Every URL is recorded in the crawl journal as soon as it is fetched, so a re-run
+    # picks up where the last one left off (see journal.py). Posters pickled by older
+    # versions of this script are imported the first time.
+    with Journal() as journal:
+        posters = journal.table("posters", legacy_path="posters.p")
+        stats = {"cache": 0, "missing": 0, "failed": 0}
+
+        # Get URLs
+        print("Downloading poster URLs...")
+        titles_bar = tqdm.tqdm(total=len(titles.index))
+        with Stage("tmdb", **stage_options) as stage:
+            futures = {}
+            for tconst in titles.index:
+
+                # Already cached
+                if tconst in posters:
+                    stats["cache"] += 1
+                    titles_bar.update()
+                    continue
+
+                future = stage.submit(fetch_poster_url, tconst, api_url, api_key)
+                futures[future] = tconst
+
+            # Results are only recorded by this thread, as they come in
+            for future in concurrent.futures.as_completed(futures):
+                tconst = futures[future]
+                if future.exception() is not None:
+                    stats["failed"] += 1
+                else:
+                    posters[tconst] = url = future.result()
+                    if url == DEFAULT_POSTER_URL:
+                        stats["missing"] += 1
+
+                titles_bar.update()
+                titles_bar.set_postfix({**stats, "throttled": stage.throttled})
+
+        titles_bar.close()
+
+        # Update dataframe
+        titles = titles.copy()
+        titles["poster"] = pd.Series(dict(posters.items()))
 
-# Downloads posters for every title in the dataframe
-def fetch_posters(titles, api_key):
-    TMDB_API_URL = "https://api.themoviedb.org/3/movie/{}?api_key={}"
-    TMDB_ROOT_POSTER_URL = "https://image.tmdb.org/t/p/w200"
-    DEFAULT_POSTER_URL = (
-        "https://i.pinimg.com/736x/b6/01/18/b6011825cf909d54d93145b53bdb0bfb.jpg"
-    )
+    return titles
 
-    # Function to fetch a single poster URL
-    @backoff.on_exception(backoff.expo, urllib.error.HTTPError)
-    def fetch_poster_url(tconst):
-        result = requests.get(TMDB_API_URL.format(tconst, api_key)).json()
-        # Got a poster
-        if "poster_path" in result and result["poster_path"] != None:
-            return f"{TMDB_ROOT_POSTER_URL}{result['poster_path']}"
-        # Got a valid reply, but no poster is available
-        elif "id" in result and "title" in result:
-            return DEFAULT_POSTER_URL
-        # No entry in TMDB
-        elif "status_code" in result and result["status_code"] == 34:
-            return DEFAULT_POSTER_URL
-        else:
-            print(result)
-            return DEFAULT_POSTER_URL
-
-    # Load cache if it exists
-    posters = {}
-    cache_hits = 0
-
-    if os.path.exists("posters.p"):
-        with open("posters.p", "rb") as f:
-            posters = pickle.load(f)
-
-    # Get URLs
-    print("Downloading poster URLs...")
-    missing = 0
-    titles_bar = tqdm.tqdm(titles.index)
-    for i, tconst in enumerate(titles_bar):
-
-        url = None
-        # Already cached
-        if tconst in posters:
-            cache_hits += 1
-            url = posters[tconst]
-            continue
-
-        posters[tconst] = url = fetch_poster_url(tconst)
-        if url == DEFAULT_POSTER_URL:
-            missing += 1
-
-        # Cache write
-        if i % 100 == 0 or i == len(titles.index) - 1:
-            with open("posters.p", "wb") as f:
-                pickle.dump(posters, f)
-
-        titles_bar.set_postfix({"cache": cache_hits, "missing": missing})
-
-    # Update dataframe
-    titles = titles.copy()
-    titles["poster"] = pd.Series(posters)
 
-    return titles
+# Fetches the poster URL of a single title from TMDB
+def fetch_poster_url(stage, tconst, api_url, api_key):
+    url = f"{api_url}/movie/{tconst}"
+    try:
+        result = stage.request("GET", url, params={"api_key": api_key}).json()
+    except requests.HTTPError as e:
+        # TMDB answers with a 404 for titles it doesn't have
+        if e.response.status_code != 404:
+            raise
+        result = e.response.json()
+
+    # Got a poster
+    if "poster_path" in result and result["poster_path"] != None:
+        return f"{TMDB_ROOT_POSTER_URL}{result['poster_path']}"
+    # Got a valid reply, but no poster is available
+    elif "id" in result and "title" in result:
+        return DEFAULT_POSTER_URL
+    # No entry in TMDB
+    elif "status_code" in result and result["status_code"] == 34:
+        return DEFAULT_POSTER_URL
+    else:
+        print(result)
+        return DEFAULT_POSTER_URL
 
 
 # Generates a Sqlite3 database for the movie/name data
@@ -209,11 +368,50 @@ def make_db(titles, names):
     # Write titles (list of movies) and names (to allow lookup of movies with the same people)
     conn = sqlite3.connect("imdb.db")
     titles.to_sql("titles", conn)
-    names.to_sql("names", conn)
 
+    # Keep the names of directors/writers for movies_serving as we go
+    people = set()
+    for column in ("directors", "writers"):
+        people.update(
+            nconst for nconsts in titles[column] for nconst in nconsts.split(",")
+        )
+    person_names = {}
+    for names_chunk in names:
+        referenced = names_chunk[names_chunk.index.isin(people)]
+        for nconst, name in referenced.name.items():
+            person_names[nconst] = None if pd.isna(name) else name
+        if SLIM_DB:
+            names_chunk = referenced
+        names_chunk.to_sql("names", conn, if_exists="append")
+
+    make_serving_table(conn, titles, person_names)
     conn.close()
 
 
+# Writes the movies_serving table (see SERVING_SCHEMA), given a dictionary of nconst -> name.
+# Names are resolved the same way the server resolves them from the names table.
+def make_serving_table(conn, titles, person_names):
+    def resolve(nconsts):
+        return json.dumps(
+            [person_names.get(nconst, "") for nconst in nconsts.split(",")]
+        )
+
+    serving = titles.copy()
+    serving.insert(
+        serving.columns.get_loc("directors") + 1,
+        "directorNames",
+        serving.directors.map(resolve),
+    )
+    serving.insert(
+        serving.columns.get_loc("writers") + 1,
+        "writerNames",
+        serving.writers.map(resolve),
+    )
+
+    conn.execute(SERVING_SCHEMA)
+    serving.to_sql("movies_serving", conn, if_exists="append")
+
+
 # Executes a simple test query against the database to make sure it looks alright
 def test_db():
     TEST_QUERY = "SELECT * from titles WHERE title LIKE '%Hulk'"
@@ -232,14 +430,130 @@ def test_db():
             print(f"\t{row}")
 
 
-# Deletes .tsv files downloaded from IMDB
+# Deletes .tsv files extracted from the IMDB archives by older versions of this script. The
+# archives themselves are kept, so the next run only downloads the ones that changed.
 def delete_tsvs():
     for file in glob.glob("*.tsv"):
         os.remove(file)
 
 
+# Builds imdb.db from fake IMDB datasets for n movies, downloaded from a local stand-in for
+# IMDB's website (see mock_servers.py) in a temporary directory. Checks that the archives
+# are downloaded intact even though some requests fail, that a refresh only downloads the
+# archives that changed, and that the database is built straight from the archives.
+def run_test(n_movies=2000):
+    import mock_servers
+
+    datasets = mock_servers.fake_imdb_datasets(n_movies)
+    new_ratings = mock_servers.fake_imdb_datasets(n_movies + 1)["title.ratings.tsv.gz"]
+    server = mock_servers.serve_datasets(datasets, failure_rate=0.1)
+    with server as server, tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            start = time.time()
+            first = download_files(server.url)
+            first_time = time.time() - start
+            for filename, remote_name in DATASETS.items():
+                with open(filename, "rb") as f:
+                    assert f.read() == datasets[remote_name], f"{filename} is corrupt"
+
+            # Nothing changed, and then just the ratings did
+            start = time.time()
+            refresh = download_files(server.url)
+            refresh_time = time.time() - start
+            server.publish("title.ratings.tsv.gz", new_ratings)
+            update = download_files(server.url)
+            with open("ratings.tsv.gz", "rb") as f:
+                assert f.read() == new_ratings, "ratings.tsv.gz wasn't updated"
+
+            titles, names = load_data()
+            make_db(titles, names)
+            conn = sqlite3.connect("imdb.db")
+            with conn:
+                query = "SELECT tconst FROM movies_serving ORDER BY tconst"
+                tconsts = [row[0] for row in conn.execute(query)]
+            conn.close()
+            leftovers = glob.glob("*.tsv") + glob.glob("*.tmp")
+        finally:
+            os.chdir(cwd)
+
+    print(f"download: {first_time:.2f}s, refresh: {refresh_time:.2f}s")
+    assert first == {"downloaded": len(DATASETS), "unchanged": 0}, first
+    assert refresh == {"downloaded": 0, "unchanged": len(DATASETS)}, refresh
+    assert update == {"downloaded": 1, "unchanged": len(DATASETS) - 1}, update
+    assert server.downloads == len(DATASETS) + 1, server.downloads
+    assert tconsts == mock_servers.expected_imdb_movies(n_movies), "Wrong movies"
+    assert leftovers == [], leftovers
+    print("OK")
+
+
+# Fetches the posters of n fake movies from a local stand-in for TMDB's API (see
+# mock_servers.py) in a temporary directory, one request at a time, with TMDB_STAGE, and
+# with no rate limit at all (so the stand-in throttles us). Checks the posters, and reports
+# how long each run took and how many requests the stand-in throttled.
+def run_poster_test(n_movies=200):
+    import mock_servers
+
+    titles = pd.DataFrame(
+        {"title": [title for tconst, title in mock_servers.fake_movies(n_movies)]},
+        index=[tconst for tconst, title in mock_servers.fake_movies(n_movies)],
+    )
+    expected = {}
+    for tconst in titles.index:
+        path = mock_servers.expected_poster_path(tconst)
+        expected[tconst] = DEFAULT_POSTER_URL
+        if path is not None:
+            expected[tconst] = f"{TMDB_ROOT_POSTER_URL}{path}"
+
+    unlimited = {**TMDB_STAGE, "rate": None}
+    runs = [
+        ("serial", {"concurrency": 1, "rate": None}),
+        ("concurrent", TMDB_STAGE),
+        ("unlimited", unlimited),
+    ]
+    with mock_servers.serve_tmdb(failure_rate=0.02) as server:
+        cwd = os.getcwd()
+        for name, stage_options in runs:
+            throttled = server.throttled
+            with tempfile.TemporaryDirectory() as tmp:
+                os.chdir(tmp)
+                try:
+                    start = time.time()
+                    api_url = f"{server.url}/3"
+                    posters = fetch_posters(titles, "test", api_url, stage_options)
+                    elapsed = time.time() - start
+
+                    # A second run should be served entirely from the journal
+                    rerun = fetch_posters(titles, "test", api_url, stage_options)
+                finally:
+                    os.chdir(cwd)
+
+            print(
+                f"{name}: {elapsed:.1f}s ({len(titles) / elapsed:.1f} titles/sec), "
+                f"{server.throttled - throttled} requests throttled"
+            )
+            assert posters.poster.to_dict() == expected, "Fetched posters don't match"
+            assert rerun.poster.to_dict() == expected, "Journaled posters don't match"
+
+    print("OK")
+
+
 if __name__ == "__main__":
 
+    # Usage:
+    # - python gen_imdb_db.py: download the IMDB datasets and build imdb.db
+    # - python gen_imdb_db.py test [number of movies]: test downloading the datasets and
+    #   building imdb.db end to end against a local stand-in for IMDB's website
+    # - python gen_imdb_db.py test-posters [number of movies]: test fetching posters
+    #   against a local stand-in for TMDB's API
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        run_test(*map(int, sys.argv[2:3]))
+        exit(0)
+    elif len(sys.argv) > 1 and sys.argv[1] == "test-posters":
+        run_poster_test(*map(int, sys.argv[2:3]))
+        exit(0)
+
     download_posters = (
         input("Download movie posters? This might take a long time! y/N\n> ")
         .strip()
@@ -1,11 +1,56 @@
-import os, sqlite3, requests, pickle, backoff, urllib, shutil
-from bs4 import BeautifulSoup
-from SPARQLWrapper import SPARQLWrapper, JSON
+import os, sys, re, html, sqlite3, pickle, queue, tempfile, time, zlib, itertools
+import collections, multiprocessing, requests, lxml.etree
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from crawler import Stage, AdaptiveBatchSize
+from journal import Journal, dump_dict
 
 
 LOCAL_WIKIPEDIA_ROOT = "http://localhost:8888/wikipedia_en_movies_nopic_2021-10/A"
 
+# Wikidata's SPARQL endpoint, used to look up the Wikipedia page of each movie
+SPARQL_ENDPOINT = "https://query.wikidata.org/sparql"
+
+# Concurrency (parallel requests) and rate limit (requests per second, None for no limit)
+# of each crawl stage. Wikidata allows a handful of parallel queries per IP (and each one
+# looks up a whole batch of movies), while the local Kiwix instance can take as many as
+# we have threads for.
+STAGES = {
+    "sparql": {"concurrency": 4, "rate": None},
+    "kiwix": {"concurrency": 16, "rate": None},
+}
+
+# Most IMDB IDs looked up per SPARQL query. Batches shrink automatically whenever a query
+# times out, and grow back to this size as queries succeed again.
+SPARQL_BATCH_SIZE = 400
+
+# Attempts per request (with exponential backoff) before a movie is given up on. Movies
+# that were given up on are retried the next time the script is run.
+MAX_TRIES = 5
+
+# A page's critical response section is the last section whose heading contains one of
+# these words. Every crawled page is kept in the crawl journal, so after changing them, run
+# `python gen_wikipedia_db.py extract` to extract the sections again without a re-crawl.
+RESPONSE_KEYWORDS = ("critical", "response")
+
+# Processes that extract sections from pages (None for one per CPU), and how many pages
+# are handed to them at a time when the sections are extracted again
+EXTRACT_PROCESSES = None
+EXTRACT_BATCH_SIZE = 1000
+
+# Kiwix lays out each section of a page as a <details> element whose <summary> is the
+# section heading. These find the headings, and the start of the element around one, once
+# comments, scripts, and styles (which can contain anything) are blanked out.
+SUMMARY_PATTERN = re.compile(r"<summary\b[^>]*>(.*?)</summary\s*>", re.S | re.I)
+TAG_PATTERN = re.compile(r"<[^>]*>")
+SECTION_START_PATTERN = re.compile(r"<details\b[^>]*>\s*", re.I)
+HIDDEN_PATTERN = re.compile(
+    r"<!--.*?(?:-->|\Z)|<(script|style)\b.*?(?:</\1\s*>|\Z)", re.S | re.I
+)
+
+# Elements whose text isn't part of a section's text
+HIDDEN_ELEMENTS = ("script", "style", lxml.etree.Comment)
+
 # Fetches a list of all IMDB tconsts + titles in the database
 def get_imdb_movies():
     assert os.path.exists("imdb.db")
@@ -17,119 +62,429 @@ def get_imdb_movies():
         return list(cur.fetchall())
 
 
-# Returns a function that executes IMDB ID lookup queries against Wikidata
-def generate_sparql_executor():
-    sparql = SPARQLWrapper("https://query.wikidata.org/sparql")
+# Looks up the local Wikipedia URLs of a batch of movies on Wikidata with a single query.
+# Returns a dictionary with the URL of each movie, or None if it has no English Wikipedia
+# page. If the query times out, the batch is split in half and each half is looked up
+# separately, and batch_size is shrunk for the batches that follow.
+def lookup_movie_urls(stage, tconsts, sparql_endpoint, wikipedia_root, batch_size):
+    imdb_ids = " ".join(f"'{tconst}'" for tconst in tconsts)
+    query = f"""
+        SELECT ?imdb ?wppage WHERE {{
+        VALUES ?imdb {{ {imdb_ids} }}
+        ?subject wdt:P345 ?imdb .
+        ?wppage schema:about ?subject .
+        FILTER(contains(str(?wppage),'//en.wikipedia'))
+    }}
+    """.strip()
 
-    @backoff.on_exception(backoff.expo, urllib.error.HTTPError)
-    def lookup_movie(movie):
-        tconst, title = movie
-        query = f"""
-            SELECT ?wppage WHERE {{
-            ?subject wdt:P345 '{tconst}' . 
-            ?wppage schema:about ?subject .
-            FILTER(contains(str(?wppage),'//en.wikipedia'))
-        }}
-        """.strip()
+    # POST, since a query with hundreds of IDs is too long for a URL
+    try:
+        result = stage.request(
+            "POST",
+            sparql_endpoint,
+            data={"query": query, "format": "json"},
+            headers={"Accept": "application/sparql-results+json"},
+        ).json()
+    except requests.RequestException as e:
+        if len(tconsts) == 1 or not is_query_timeout(e):
+            raise
+        batch_size.shrink(len(tconsts))
+        half = len(tconsts) // 2
+        args = (sparql_endpoint, wikipedia_root, batch_size)
+        urls = lookup_movie_urls(stage, tconsts[:half], *args)
+        urls.update(lookup_movie_urls(stage, tconsts[half:], *args))
+        return urls
+    batch_size.grow()
 
-        sparql.setQuery(query)
-        sparql.setReturnFormat(JSON)
+    # Keep the last page of each movie, like a query for just that movie would
+    urls = dict.fromkeys(tconsts)
+    for binding in result["results"]["bindings"]:
+        remote_url = binding["wppage"]["value"]
+        urls[binding["imdb"]["value"]] = to_local_url(remote_url, wikipedia_root)
+    return urls
 
-        result = sparql.query().convert()
 
-        try:
-            remote_url = result["results"]["bindings"][-1]["wppage"]["value"]
-            leaf = remote_url.split("/")[-1]
-            local_url = f"{LOCAL_WIKIPEDIA_ROOT.rstrip('/')}/{leaf}"
+# Returns whether a failed SPARQL query ran out of time. Wikidata cancels queries after a
+# minute and answers with a 500 that mentions a TimeoutException (or a 504 from its proxy).
+def is_query_timeout(e):
+    if isinstance(e, requests.Timeout):
+        return True
+    response = getattr(e, "response", None)
+    if response is None:
+        return False
+    return response.status_code == 504 or (
+        response.status_code == 500 and "TimeoutException" in response.text
+    )
 
-            return (tconst, title, local_url)
-        except Exception as e:
-            return (tconst, title, None)
 
-    return lookup_movie
+# Maps the URL of an English Wikipedia page to the same page on our Kiwix instance
+def to_local_url(remote_url, wikipedia_root):
+    leaf = remote_url.split("/")[-1]
+    return f"{wikipedia_root.rstrip('/')}/{leaf}"
 
 
-if __name__ == "__main__":
-    # Get all movie IDs
-    movies = get_imdb_movies()
+# Fetches a movie's page from our Kiwix instance, and returns it compressed, to be kept
+# in the crawl journal and handed to extract_page
+def fetch_movie_html(stage, url):
+    return zlib.compress(stage.request("GET", url).text.encode("utf-8"))
 
-    # Get our SPARQL executor
-    lookup_movie = generate_sparql_executor()
 
-    # Lookup each movie, and store the reviews section of it locally
-    # This will probably consume a lot of RAM
-    # We'll make sure to load anything cached to disk in case this script is being re-run
-    movie_urls = {}
-    if os.path.exists("movie_urls.p"):
-        with open("movie_urls.p", "rb") as f:
-            movie_urls = pickle.load(f)
-    movie_responses = {}
-    if os.path.exists("movie_responses.p"):
-        with open("movie_responses.p", "rb") as f:
-            movie_responses = pickle.load(f)
-    url_cache_hits = 0
-    response_cache_hits = 0
-
-    movies_bar = tqdm(movies)
-    for i, movie in enumerate(movies_bar):
-
-        tconst, title = movie
-        url = None
-
-        # Check if URL is in our cache
-        if tconst in movie_urls:
-            # print(f"URL for {tconst} is cached: {movie_urls[tconst]}")
-            url = movie_urls[tconst]
-            url_cache_hits += 1
-        # Otherwise do SPARQL lookup to get the URL
-        else:
-            tconst, title, url = lookup_movie(movie)
-            movie_urls[tconst] = url
-
-        # Check if we have a critic response in our cache
-        response_text = None
-        if tconst in movie_responses:
-            response_text = movie_responses[tconst]
-            response_cache_hits += 1
-        # Otherwise query """Wikipedia""" if we have a URL
-        elif url is not None:
-            html = requests.get(url).text
-            soup = BeautifulSoup(html, "html.parser")
-            sections = soup.find_all("summary")
-
-            # Find the critical response/reviews section
-            # Usually they are near the end of the document
-            response_section = None
-            for section in sections:
-                text = section.get_text().lower()
-                if "critical" in text or "response" in text:
-                    response_section = section
-
-            # Now we can just extract the text of the critical response section, and save this info
-            if response_section is not None:
-                response_text = response_section.parent.text
-                movie_responses[tconst] = response_text
-        elif url is None:
-            # No wikipedia URL, so we have nothing
-            movie_responses[tconst] = ""
-
-        # Update our cache every 100 lookups
-        if i % 100 == 0:
-            with open("movie_urls.p", "wb") as f:
-                pickle.dump(movie_urls, f)
-            with open("movie_responses.p", "wb") as f:
-                pickle.dump(movie_responses, f)
-
-        # Update progress bar with cache hit rate
-        movies_bar.set_postfix(
-            {"URL cache": url_cache_hits, "Response cache": response_cache_hits}
+# Extracts the critical response section of a page returned by fetch_movie_html
+def extract_page(page, keywords=RESPONSE_KEYWORDS):
+    return extract_response(zlib.decompress(page).decode("utf-8"), keywords)
+
+
+# Extracts the text of the critical response section of a Wikipedia page, or returns None if
+# the page doesn't have one. The headings are found with a quick scan of the page, and only
+# the section itself is parsed, up to where it ends. For well-formed pages, the text is the
+# same as BeautifulSoup's for the section.
+def extract_response(page_html, keywords=RESPONSE_KEYWORDS):
+    # Find the critical response/reviews section
+    # Usually they are near the end of the document
+    # Hidden parts are blanked out with spaces, so offsets into the page stay the same
+    visible_html = HIDDEN_PATTERN.sub(lambda hidden: " " * len(hidden[0]), page_html)
+    response_heading = None
+    for heading in SUMMARY_PATTERN.finditer(visible_html):
+        text = html.unescape(TAG_PATTERN.sub("", heading.group(1))).lower()
+        if any(keyword in text for keyword in keywords):
+            response_heading = heading
+
+    if response_heading is None:
+        return None
+
+    # Parse the section from its start tag, and stop as soon as it ends. Fall back to
+    # parsing the whole page if the heading isn't the first thing in a <details>.
+    start = visible_html.rfind("<details", 0, response_heading.start())
+    if start < 0 or not SECTION_START_PATTERN.fullmatch(
+        visible_html, start, response_heading.start()
+    ):
+        return _extract_response_from_tree(page_html, keywords)
+
+    parser = lxml.etree.HTMLPullParser(events=("start", "end"))
+    section = None
+    for offset in range(start, len(page_html), 1 << 14):
+        parser.feed(page_html[offset : offset + (1 << 14)])
+        for event, element in parser.read_events():
+            if event == "start" and section is None and element.tag == "details":
+                section = element
+            elif event == "end" and element is section:
+                return _text(section)
+    parser.close()
+    return _text(section)
+
+
+# Extracts the critical response section of a page from its whole tree
+def _extract_response_from_tree(page_html, keywords):
+    root = lxml.etree.fromstring(page_html, lxml.etree.HTMLParser())
+    response_section = None
+    for section in root.iter("summary"):
+        text = "".join(section.itertext()).lower()
+        if any(keyword in text for keyword in keywords):
+            response_section = section
+
+    if response_section is None:
+        return None
+    return _text(response_section.getparent())
+
+
+# Returns the text of an element without scripts, styles, and comments, with whitespace-only
+# strings shortened to a newline or a space like BeautifulSoup does
+def _text(element):
+    lxml.etree.strip_elements(element, *HIDDEN_ELEMENTS, with_tail=False)
+    strings = []
+    for string in element.itertext():
+        if string.isspace():
+            string = "\n" if "\n" in string else " "
+        strings.append(string)
+    return "".join(strings)
+
+
+# Crawls the critical response section of every movie that isn't in movie_responses yet,
+# updating movie_urls, movie_html, and movie_responses as results come in. URLs are looked
+# up in batches on the SPARQL stage, each page is fetched on the Kiwix stage as soon as its
+# URL is known, and its section is extracted in a separate process as soon as it comes in,
+# so both services and the parsing are kept busy at once. Pages that were fetched before
+# aren't fetched again. Results are only ever recorded by the calling thread.
+def crawl(
+    movies,
+    movie_urls,
+    movie_html,
+    movie_responses,
+    sparql_endpoint=SPARQL_ENDPOINT,
+    wikipedia_root=LOCAL_WIKIPEDIA_ROOT,
+    stages=STAGES,
+    max_batch_size=SPARQL_BATCH_SIZE,
+    extract_processes=EXTRACT_PROCESSES,
+):
+    # Workers report finished calls here as ("urls", tconsts, future), ("html", tconst,
+    # future), or ("response", tconst, future)
+    done = queue.Queue()
+    stats = {"URL cache": 0, "HTML cache": 0, "Response cache": 0, "failed": 0}
+    movies_bar = tqdm(total=len(movies))
+
+    sparql = Stage("sparql", max_tries=MAX_TRIES, **stages["sparql"])
+    kiwix = Stage("kiwix", max_tries=MAX_TRIES, **stages["kiwix"])
+    extractor = make_extractor(extract_processes)
+    with sparql, kiwix, extractor:
+
+        def submit(executor, kind, key, fn, *args):
+            future = executor.submit(fn, *args)
+            future.add_done_callback(lambda future: done.put((kind, key, future)))
+
+        # Fetch the page of a movie with a known URL, or record that it has nothing
+        def fetch(tconst, url):
+            if url is None:
+                movie_responses[tconst] = ""
+                return False
+            submit(kiwix, "html", tconst, fetch_movie_html, url)
+            return True
+
+        # Batches are only formed once a SPARQL thread is free to run them, so they
+        # follow the current batch size
+        unresolved = collections.deque()
+        batch_size = AdaptiveBatchSize(max_batch_size)
+        batches = 0
+
+        def submit_batches():
+            nonlocal batches
+            while unresolved and batches < stages["sparql"]["concurrency"]:
+                size = min(batch_size.size, len(unresolved))
+                tconsts = [unresolved.popleft() for _ in range(size)]
+                args = (tconsts, sparql_endpoint, wikipedia_root, batch_size)
+                submit(sparql, "urls", tconsts, lookup_movie_urls, *args)
+                batches += 1
+
+        pending = 0
+        for tconst, title in movies:
+            if tconst in movie_responses:
+                stats["Response cache"] += 1
+                movies_bar.update()
+            elif tconst in movie_html:
+                stats["HTML cache"] += 1
+                page = movie_html[tconst]
+                submit(extractor, "response", tconst, extract_page, page)
+                pending += 1
+            elif tconst in movie_urls:
+                stats["URL cache"] += 1
+                if fetch(tconst, movie_urls[tconst]):
+                    pending += 1
+                else:
+                    movies_bar.update()
+            else:
+                unresolved.append(tconst)
+                pending += 1
+        submit_batches()
+
+        while pending > 0:
+            kind, key, future = done.get()
+            if kind == "urls":
+                batches -= 1
+                submit_batches()
+
+            # Every movie of a batch is done unless its page still has to be fetched, and a
+            # page is done once its section has been extracted
+            finished = 1
+            if future.exception() is not None:
+                finished = len(key) if kind == "urls" else 1
+                stats["failed"] += finished
+            elif kind == "urls":
+                movie_urls.update(future.result())
+                finished = sum(not fetch(tconst, movie_urls[tconst]) for tconst in key)
+            elif kind == "html":
+                movie_html[key] = future.result()
+                submit(extractor, "response", key, extract_page, future.result())
+                finished = 0
+            elif future.result() is not None:
+                movie_responses[key] = future.result()
+
+            pending -= finished
+            movies_bar.update(finished)
+            movies_bar.set_postfix(
+                {
+                    **stats,
+                    "batch": batch_size.size,
+                    "retries": sparql.retries + kiwix.retries,
+                }
+            )
+
+    movies_bar.close()
+    return stats
+
+
+# Returns a pool of processes for extracting sections from pages. Processes are started
+# fresh rather than forked, since forking a process that runs threads isn't safe.
+def make_extractor(processes=EXTRACT_PROCESSES):
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(processes, mp_context=context)
+
+
+# Crawls every movie that isn't in the crawl journal yet, and writes wikipedia.p
+def build_wikipedia(movies, **crawl_options):
+    # Every result is recorded in the journal as soon as it comes in, so if this script is
+    # being re-run, it picks up where it left off. Caches pickled by older versions of the
+    # script are imported the first time.
+    with Journal() as journal:
+        movie_urls = journal.table("urls", legacy_path="movie_urls.p")
+        movie_html = journal.table("html")
+        movie_responses = journal.table("responses", legacy_path="movie_responses.p")
+        stats = crawl(movies, movie_urls, movie_html, movie_responses, **crawl_options)
+        export_wikipedia(movies, movie_responses)
+
+    return stats
+
+
+# Extracts the critical response section of every page in the crawl journal again, without
+# fetching anything (e.g. after changing RESPONSE_KEYWORDS), and writes wikipedia.p.
+# Returns how many pages there were, and how many of them have a section.
+def reextract(movies, keywords=RESPONSE_KEYWORDS, extract_processes=EXTRACT_PROCESSES):
+    stats = {"pages": 0, "responses": 0}
+    with Journal() as journal:
+        movie_html = journal.table("html")
+        movie_responses = journal.table("responses")
+        pages_bar = tqdm(total=len(movie_html))
+
+        # Hand the pages to the extractor a batch at a time, so they're never all loaded
+        with make_extractor(extract_processes) as extractor:
+            pages = movie_html.items()
+            while True:
+                batch = list(itertools.islice(pages, EXTRACT_BATCH_SIZE))
+                if len(batch) == 0:
+                    break
+
+                responses = extractor.map(
+                    extract_page,
+                    [page for tconst, page in batch],
+                    itertools.repeat(keywords),
+                    chunksize=16,
+                )
+                found = {}
+                for (tconst, page), response in zip(batch, responses):
+                    if response is not None:
+                        found[tconst] = response
+                    elif tconst in movie_responses:
+                        del movie_responses[tconst]
+                movie_responses.update(found)
+
+                stats["pages"] += len(batch)
+                stats["responses"] += len(found)
+                pages_bar.update(len(batch))
+                pages_bar.set_postfix(stats)
+
+        pages_bar.close()
+        export_wikipedia(movies, movie_responses)
+
+    return stats
+
+
+# Writes the responses of the given movies to wikipedia.p, in the same order as the movies,
+# one at a time. The export is only moved into place once it is complete.
+def export_wikipedia(movies, movie_responses):
+    with open("wikipedia.p.tmp", "wb") as f:
+        dump_dict(
+            (
+                (tconst, movie_responses[tconst])
+                for tconst, title in movies
+                if tconst in movie_responses
+            ),
+            f,
         )
+    os.replace("wikipedia.p.tmp", "wikipedia.p")
+
+
+# Crawls n fake movies from local stand-ins for Wikidata and Kiwix (see mock_servers.py) in
+# a temporary directory, checks the results, and reports how long the crawl took and how
+# many SPARQL queries it made, both with the configured stages and batches and with one
+# request at a time. The Wikidata stand-in times out queries with more than max_batch IDs.
+# Also checks that the sections can be extracted again from the crawl journal, with other
+# keywords, without fetching any page again.
+def run_test(n_movies=300, max_batch=150):
+    import mock_servers
+
+    movies = mock_servers.fake_movies(n_movies)
+    expected = {
+        tconst: mock_servers.expected_response(tconst)
+        for tconst, title in movies
+        if mock_servers.expected_response(tconst) is not None
+    }
+    pages = [tconst for tconst in expected if expected[tconst] != ""]
+    pages += [
+        tconst
+        for tconst, title in movies
+        if mock_servers.expected_response(tconst) is None
+    ]
+    serial = {name: {"concurrency": 1, "rate": None} for name in STAGES}
+    runs = [("serial", serial, 1), ("concurrent", STAGES, SPARQL_BATCH_SIZE)]
+
+    sparql_server = mock_servers.serve_sparql(failure_rate=0.02, max_batch=max_batch)
+    kiwix_server = mock_servers.serve_kiwix(failure_rate=0.02)
+    with sparql_server as sparql_server, kiwix_server as kiwix_server:
+        crawl_options = {
+            "sparql_endpoint": f"{sparql_server.url}/sparql",
+            "wikipedia_root": f"{kiwix_server.url}{mock_servers.KIWIX_ROOT_PATH}",
+        }
+
+        cwd = os.getcwd()
+        for name, stages, max_batch_size in runs:
+            crawl_options.update(stages=stages, max_batch_size=max_batch_size)
+            queries = sparql_server.requests
+            with tempfile.TemporaryDirectory() as tmp:
+                os.chdir(tmp)
+                try:
+                    start = time.time()
+                    stats = build_wikipedia(movies, **crawl_options)
+                    elapsed = time.time() - start
+                    queries = sparql_server.requests - queries
+                    with open("wikipedia.p", "rb") as f:
+                        wikipedia = pickle.load(f)
 
-    # Final cache update
-    with open("movie_urls.p", "wb") as f:
-        pickle.dump(movie_urls, f)
-    with open("movie_responses.p", "wb") as f:
-        pickle.dump(movie_responses, f)
+                    # A second run should be served entirely from the journal
+                    fetched = kiwix_server.requests
+                    rerun_stats = build_wikipedia(movies, **crawl_options)
+                    with open("wikipedia.p", "rb") as f:
+                        rerun = pickle.load(f)
 
-    # Copy movie_responses.p to wikipedia.p
-    shutil.copyfile("movie_responses.p", "wikipedia.p")
+                    # And so should extracting other sections, and then the same ones
+                    plot_stats = reextract(movies, keywords=("plot",))
+                    with open("wikipedia.p", "rb") as f:
+                        plots = pickle.load(f)
+                    reextract(movies)
+                    with open("wikipedia.p", "rb") as f:
+                        reextracted = pickle.load(f)
+                    fetched = kiwix_server.requests - fetched
+                finally:
+                    os.chdir(cwd)
+
+            print(
+                f"{name}: {elapsed:.1f}s ({len(movies) / elapsed:.1f} movies/sec), "
+                f"{queries} SPARQL queries"
+            )
+            assert stats["failed"] == 0, stats
+            assert wikipedia == expected, "Crawled responses don't match"
+            assert list(wikipedia) == list(expected), "Responses are out of order"
+            assert rerun == expected, "Journaled responses don't match"
+            assert rerun_stats["Response cache"] == len(expected), rerun_stats
+            assert rerun_stats["HTML cache"] == len(movies) - len(expected), rerun_stats
+            assert plot_stats == {"pages": len(pages), "responses": len(pages)}
+            assert all(plots[tconst].startswith("Plot") for tconst in pages)
+            assert reextracted == expected, "Re-extracted responses don't match"
+            assert fetched == 0, f"{fetched} pages were fetched again"
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    # Usage:
+    # - python gen_wikipedia_db.py: crawl every movie in imdb.db and write wikipedia.p
+    # - python gen_wikipedia_db.py extract: extract the section of every crawled page
+    #   again, and write wikipedia.p
+    # - python gen_wikipedia_db.py test [number of movies]: test the crawler end to end
+    #   against local stand-ins for Wikidata and Kiwix
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        run_test(*map(int, sys.argv[2:3]))
+        exit(0)
+    elif len(sys.argv) > 1 and sys.argv[1] == "extract":
+        reextract(get_imdb_movies())
+        exit(0)
+
+    # Lookup each movie, and store the reviews section of it locally
+    build_wikipedia(get_imdb_movies())
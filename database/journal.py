@@ -0,0 +1,151 @@
+import os, sqlite3, pickle, struct, threading
+from collections.abc import MutableMapping
+
+"""
+An append-only store for the results of long crawls, so that they can be stopped and
+resumed at any point. Results are kept in a Sqlite3 database in WAL mode, with one table
+of key -> value pairs per kind of result. Every result is committed as soon as it is
+recorded, so a crash loses at most the results that were still in flight, and resuming
+a crawl doesn't have to load (or rewrite) anything that was recorded before.
+
+Usage:
+    journal = Journal("crawl.db")
+    urls = journal.table("urls")
+    urls["tt0800080"] = "http://..."
+"""
+
+# Default path of the journal shared by the scripts in this folder
+JOURNAL_PATH = "crawl.db"
+
+# Pragmas applied to the journal's connection. With WAL, every commit is a sequential
+# append to the log, and synchronous=NORMAL only syncs it to disk at checkpoints (a power
+# cut can lose the last few results, but never corrupt the journal).
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+}
+
+
+# A Sqlite3 database of crawl results, shared by any number of tables
+class Journal:
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        for pragma, value in SQLITE_PRAGMAS.items():
+            self.conn.execute(f"PRAGMA {pragma}={value}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Returns the table of results called name, creating it if it doesn't exist yet. If the
+    # table is new and a pickled dictionary exists at legacy_path (e.g. a checkpoint from an
+    # older version of the scripts), its contents are imported first.
+    def table(self, name, legacy_path=None):
+        with self.lock:
+            exists = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)
+            ).fetchone()
+            self.conn.execute(
+                f'CREATE TABLE IF NOT EXISTS "{name}" '
+                "(key TEXT PRIMARY KEY, value) WITHOUT ROWID"
+            )
+
+        table = JournalTable(self, name)
+        if not exists and legacy_path is not None and os.path.exists(legacy_path):
+            with open(legacy_path, "rb") as f:
+                table.update(pickle.load(f))
+        return table
+
+    def close(self):
+        self.conn.close()
+
+
+# A dictionary-like view of one table of a journal. Reads go to the database, and every
+# write is committed straight away.
+class JournalTable(MutableMapping):
+    def __init__(self, journal, name):
+        self.journal = journal
+        self.name = name
+
+    def __getitem__(self, key):
+        row = self._fetchone(f'SELECT value FROM "{self.name}" WHERE key=?', (key,))
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __contains__(self, key):
+        query = f'SELECT 1 FROM "{self.name}" WHERE key=?'
+        return self._fetchone(query, (key,)) is not None
+
+    def __setitem__(self, key, value):
+        self.update([(key, value)])
+
+    def __delitem__(self, key):
+        query = f'DELETE FROM "{self.name}" WHERE key=?'
+        with self.journal.lock:
+            deleted = self.journal.conn.execute(query, (key,)).rowcount
+        if deleted == 0:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return (key for key, value in self.items())
+
+    def __len__(self):
+        return self._fetchone(f'SELECT COUNT(*) FROM "{self.name}"')[0]
+
+    # Records many results in a single transaction
+    def update(self, items=(), **kwargs):
+        if isinstance(items, dict):
+            items = items.items()
+        items = [*items, *kwargs.items()]
+        query = f'INSERT OR REPLACE INTO "{self.name}" (key, value) VALUES (?, ?)'
+        with self.journal.lock, self.journal.conn:
+            self.journal.conn.execute("BEGIN")
+            self.journal.conn.executemany(query, items)
+
+    # Streams every (key, value) pair in the table, in key order, without loading them all
+    def items(self):
+        query = f'SELECT key, value FROM "{self.name}" ORDER BY key'
+        with self.journal.lock:
+            cursor = self.journal.conn.execute(query)
+        while True:
+            with self.journal.lock:
+                rows = cursor.fetchmany(1000)
+            if len(rows) == 0:
+                break
+            yield from rows
+
+    def _fetchone(self, query, params=()):
+        with self.journal.lock:
+            return self.journal.conn.execute(query, params).fetchone()
+
+
+# Writes a dictionary of strings to a pickle file, given its (key, value) pairs one at a
+# time, so the dictionary never has to be held in memory. The result is identical to
+# pickle.dump(dict(items), f) as far as pickle.load is concerned.
+def dump_dict(items, f, batch_size=1000):
+    f.write(pickle.PROTO + bytes([2]) + pickle.EMPTY_DICT)
+
+    def write_str(s):
+        data = s.encode("utf-8", "surrogatepass")
+        f.write(pickle.BINUNICODE + struct.pack("<I", len(data)) + data)
+
+    # Add items to the dictionary in batches, like the pickle module does
+    batch = 0
+    for key, value in items:
+        if batch == 0:
+            f.write(pickle.MARK)
+        write_str(key)
+        write_str(value)
+        batch += 1
+        if batch == batch_size:
+            f.write(pickle.SETITEMS)
+            batch = 0
+    if batch > 0:
+        f.write(pickle.SETITEMS)
+
+    f.write(pickle.STOP)
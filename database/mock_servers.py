@@ -0,0 +1,436 @@
+import collections, email.utils, gzip, hashlib, json, random, re, threading, time, urllib.parse
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+Local stand-ins for the HTTP services that the scripts in this folder crawl, so they can
+be tested end to end without touching the real services. Every server generates
+deterministic fake data for any IMDB ID, and can add latency to each request and fail a
+fraction of requests with a 503 to exercise retries.
+
+- Wikidata's SPARQL endpoint (serve_sparql)
+- a Kiwix instance serving Wikipedia (serve_kiwix)
+- IMDB's dataset downloads (serve_datasets)
+- TMDB's API (serve_tmdb)
+"""
+
+# Fake movies whose number is a multiple of NO_PAGE_EVERY have no Wikipedia page, and those
+# whose number is a multiple of NO_SECTION_EVERY have a page without a critical response
+NO_PAGE_EVERY = 7
+NO_SECTION_EVERY = 11
+
+# Path of the fake Wikipedia articles on the Kiwix stand-in
+KIWIX_ROOT_PATH = "/wikipedia_en_movies_nopic_2021-10/A"
+
+# Number of fake people credited in the fake IMDB datasets. Each of them directed or wrote
+# the fake movies whose number is equal to theirs modulo FAKE_PEOPLE.
+FAKE_PEOPLE = 50
+
+# Fake movies whose number is a multiple of NOT_ON_TMDB_EVERY aren't on TMDB, and those
+# whose number is a multiple of NO_POSTER_EVERY are on TMDB without a poster
+NOT_ON_TMDB_EVERY = 6
+NO_POSTER_EVERY = 10
+
+
+# Words that the filler text of fake articles is made of
+_VOCABULARY = "film critics praised the performance plot score director cast".split()
+
+
+# Returns n fake (tconst, title) movies, like gen_wikipedia_db.get_imdb_movies
+def fake_movies(n):
+    return [(f"tt{i:07d}", f"Movie {i}") for i in range(1, n + 1)]
+
+
+# Returns the critical response section that gen_wikipedia_db should extract for a fake
+# movie, or None if it shouldn't find one
+def expected_response(tconst):
+    number = int(tconst[2:])
+    if number % NO_PAGE_EVERY == 0:
+        return ""
+    if number % NO_SECTION_EVERY == 0:
+        return None
+    return f"Critical response{_paragraph(tconst, 'response')}"
+
+
+# Returns the path of a fake movie's poster on TMDB, or None if it doesn't have one
+def expected_poster_path(tconst):
+    number = int(tconst[2:])
+    if number % NOT_ON_TMDB_EVERY == 0 or number % NO_POSTER_EVERY == 0:
+        return None
+    return f"/{tconst}.jpg"
+
+
+# Returns the Wikipedia article name of a fake movie, or None if it doesn't have one
+def _article(tconst):
+    if int(tconst[2:]) % NO_PAGE_EVERY == 0:
+        return None
+    return f"Movie_{tconst}_(film)"
+
+
+# Returns a deterministic paragraph of filler text about a fake movie
+def _paragraph(tconst, topic, words=80):
+    rng = random.Random(f"{tconst}-{topic}")
+    return " ".join(rng.choice(_VOCABULARY) for _ in range(words)) + "."
+
+
+# Returns the HTML of a fake movie's article, laid out like Kiwix's: each section is a
+# <details> element whose <summary> is the section heading
+def _article_html(tconst, filler_sections=12):
+    sections = [("Plot", "plot"), ("Production", "production")]
+    sections += [(f"Section {i}", f"filler-{i}") for i in range(filler_sections)]
+    if int(tconst[2:]) % NO_SECTION_EVERY != 0:
+        sections.append(("Critical response", "response"))
+    sections.append(("References", "references"))
+
+    body = "".join(
+        f"<details><summary>{heading}</summary><p>{_paragraph(tconst, topic)}</p></details>"
+        for heading, topic in sections
+    )
+    return (
+        f"<!DOCTYPE html><html><head><title>{tconst}</title></head>"
+        f"<body><h1>{tconst}</h1>{body}</body></html>"
+    )
+
+
+# Returns gzipped IMDB datasets for n fake movies, by their name on IMDB's website, laid out
+# like the real ones. Some of the movies are filtered out by gen_imdb_db.load_data (see
+# expected_imdb_movies), and every file has rows that load_data doesn't keep.
+def fake_imdb_datasets(n):
+    basics = [
+        "tconst\ttitleType\tprimaryTitle\toriginalTitle\tisAdult\tstartYear"
+        "\tendYear\truntimeMinutes\tgenres"
+    ]
+    akas = [
+        "titleId\tordering\ttitle\tregion\tlanguage\ttypes\tattributes"
+        "\tisOriginalTitle"
+    ]
+    crew = ["tconst\tdirectors\twriters"]
+    principals = ["tconst\tordering\tnconst\tcategory\tjob\tcharacters"]
+    ratings = ["tconst\taverageRating\tnumVotes"]
+    for tconst, title in fake_movies(n):
+        number = int(tconst[2:])
+        title_type = "tvSeries" if number % 3 == 0 else "movie"
+        year = 1985 if number % 4 == 0 else 1991 + number % 30
+        runtime = "\\N" if number % 13 == 0 else str(40 + number % 100)
+        genres = "\\N" if number % 17 == 0 else "Drama,Comedy"
+        basics.append(
+            f"{tconst}\t{title_type}\t{title}\t{title}\t0\t{year}\t\\N\t{runtime}"
+            f"\t{genres}"
+        )
+
+        regions = ["FR"] if number % 5 == 0 else ["FR", "US", "XWW"]
+        for ordering, region in enumerate(regions, 1):
+            akas.append(f"{tconst}\t{ordering}\t{title}\t{region}\t\\N\t\\N\t\\N\t0")
+
+        director = f"nm{number % FAKE_PEOPLE:07d}"
+        writers = f"{director},nm{(number + 1) % FAKE_PEOPLE:07d}"
+        if number % 9 == 0:
+            writers = "\\N"
+        crew.append(f"{tconst}\t{director}\t{writers}")
+        principals.append(f"{tconst}\t1\t{director}\tdirector\t\\N\t\\N")
+        ratings.append(f"{tconst}\t{1 + number % 90 / 10}\t{number * 7 % 5000}")
+
+    # Twice as many people as are credited, like IMDB has many more people than movies
+    names = [
+        "nconst\tprimaryName\tbirthYear\tdeathYear\tprimaryProfession"
+        "\tknownForTitles"
+    ]
+    for number in range(2 * FAKE_PEOPLE):
+        names.append(
+            f"nm{number:07d}\tPerson {number}\t{1950 + number}\t\\N\tdirector,writer"
+            f"\ttt{number + 1:07d}"
+        )
+
+    files = {
+        "name.basics.tsv.gz": names,
+        "title.akas.tsv.gz": akas,
+        "title.basics.tsv.gz": basics,
+        "title.crew.tsv.gz": crew,
+        "title.principals.tsv.gz": principals,
+        "title.ratings.tsv.gz": ratings,
+    }
+    return {
+        name: gzip.compress("\n".join(rows).encode() + b"\n", mtime=0)
+        for name, rows in files.items()
+    }
+
+
+# Returns the tconsts of the fake movies in fake_imdb_datasets(n) that gen_imdb_db.load_data
+# should keep: movies from after 1990 that run for more than 45 minutes, with a US title
+def expected_imdb_movies(n):
+    expected = []
+    for tconst, title in fake_movies(n):
+        number = int(tconst[2:])
+        if number % 3 == 0 or number % 4 == 0 or number % 5 == 0 or number % 13 == 0:
+            continue
+        if 40 + number % 100 > 45:
+            expected.append(tconst)
+    return expected
+
+
+# Base request handler: keeps connections alive, and applies the server's latency and
+# failure rate to every request
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    # Clients are free to drop keep-alive connections at any time
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def _handle(self, method):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.rng.random() < server.failure_rate
+        time.sleep(server.latency)
+
+        # Always read the body, so the connection can be reused
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        if fail:
+            self.send(503, b"Service Unavailable", "text/plain")
+        else:
+            self.respond(method, body)
+
+    # Sends a complete response
+    def send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Handles a request that wasn't failed on purpose
+    def respond(self, method, body):
+        raise NotImplementedError
+
+
+# Answers any query with an English Wikipedia page for every IMDB ID in it, and times out
+# queries with more than max_batch IDs
+class _SparqlHandler(_Handler):
+    def respond(self, method, body):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        if method == "POST":
+            params.update(urllib.parse.parse_qs(body.decode()))
+        query = params.get("query", [""])[0]
+
+        # Like Wikidata, give up on queries that would take too long
+        tconsts = re.findall(r"tt\d+", query)
+        if len(tconsts) > self.server.max_batch:
+            body = b"java.util.concurrent.TimeoutException"
+            self.send(500, body, "text/plain")
+            return
+
+        bindings = []
+        for tconst in tconsts:
+            article = _article(tconst)
+            if article is not None:
+                bindings.append(
+                    {
+                        "imdb": {"type": "literal", "value": tconst},
+                        "wppage": {
+                            "type": "uri",
+                            "value": f"https://en.wikipedia.org/wiki/{article}",
+                        },
+                    }
+                )
+
+        result = {
+            "head": {"vars": ["imdb", "wppage"]},
+            "results": {"bindings": bindings},
+        }
+        self.send(200, json.dumps(result).encode(), "application/sparql-results+json")
+
+
+# Serves the article of every fake movie under KIWIX_ROOT_PATH
+class _KiwixHandler(_Handler):
+    def respond(self, method, body):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        match = re.fullmatch(
+            re.escape(KIWIX_ROOT_PATH) + r"/Movie_(tt\d+)_\(film\)", path
+        )
+        if match is None or _article(match.group(1)) is None:
+            self.send(404, b"Not Found", "text/plain")
+        else:
+            html = _article_html(match.group(1), self.server.filler_sections)
+            self.send(200, html.encode(), "text/html; charset=utf-8")
+
+
+# Serves the files published on the server, and answers conditional requests (with
+# If-None-Match or If-Modified-Since) for a file that hasn't changed with a 304
+class _DatasetsHandler(_Handler):
+    def respond(self, method, body):
+        name = urllib.parse.urlsplit(self.path).path.lstrip("/")
+        with self.server.lock:
+            published = self.server.files.get(name)
+        if published is None:
+            self.send(404, b"Not Found", "text/plain")
+            return
+
+        data, etag, modified = published
+        headers = {
+            "ETag": etag,
+            "Last-Modified": email.utils.formatdate(modified, usegmt=True),
+        }
+
+        # Like HTTP servers do, If-Modified-Since is ignored when If-None-Match is sent
+        if "If-None-Match" in self.headers:
+            unchanged = etag in self.headers["If-None-Match"].split(", ")
+        elif "If-Modified-Since" in self.headers:
+            since = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+            unchanged = modified <= since.timestamp()
+        else:
+            unchanged = False
+
+        if unchanged:
+            self.send(304, b"", "application/octet-stream", headers)
+        else:
+            with self.server.lock:
+                self.server.downloads += 1
+            self.send(200, data, "application/octet-stream", headers)
+
+
+# Answers requests for the details of any fake movie (by IMDB ID) like TMDB's API, for the
+# server's API key. Like TMDB, it answers requests above rate per second with a 429 that
+# asks the client to come back in a second.
+class _TmdbHandler(_Handler):
+    def respond(self, method, body):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        server = self.server
+
+        # Count the requests of the last second
+        with server.lock:
+            now = time.monotonic()
+            while server.recent and server.recent[0] <= now - 1:
+                server.recent.popleft()
+            throttled = len(server.recent) >= server.rate
+            if throttled:
+                server.throttled += 1
+            else:
+                server.recent.append(now)
+
+        if throttled:
+            result = {"status_code": 25, "status_message": "Request count over limit."}
+            status, headers = 429, {"Retry-After": "1"}
+        elif params.get("api_key") != [server.api_key]:
+            result = {"status_code": 7, "status_message": "Invalid API key."}
+            status, headers = 401, {}
+        else:
+            status, result = self._movie(url.path)
+            headers = {}
+        self.send(status, json.dumps(result).encode(), "application/json", headers)
+
+    # Returns the status and body of the response for a movie's details
+    def _movie(self, path):
+        match = re.fullmatch(r"/3/movie/tt(\d+)", path)
+        if match is None or int(match.group(1)) % NOT_ON_TMDB_EVERY == 0:
+            message = "The resource you requested could not be found."
+            return 404, {"status_code": 34, "status_message": message}
+
+        tconst = f"tt{match.group(1)}"
+        number = int(match.group(1))
+        return 200, {
+            "id": number,
+            "imdb_id": tconst,
+            "title": f"Movie {number}",
+            "poster_path": expected_poster_path(tconst),
+        }
+
+
+# Runs a server with the given handler on a free local port for the duration of a with
+# block, and yields it. Every keyword argument is set as an attribute of the server.
+@contextmanager
+def _serve(handler, latency=0.0, failure_rate=0.0, seed=0, **options):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    for name, value in options.items():
+        setattr(server, name, value)
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+# Runs a stand-in for Wikidata's SPARQL endpoint. Yields the server, whose endpoint URL is
+# server.url + "/sparql".
+@contextmanager
+def serve_sparql(latency=0.2, failure_rate=0.0, max_batch=1000):
+    with _serve(_SparqlHandler, latency, failure_rate, max_batch=max_batch) as server:
+        yield server
+
+
+# Runs a stand-in for a Kiwix instance. Yields the server, whose Wikipedia root path (see
+# gen_wikipedia_db.LOCAL_WIKIPEDIA_ROOT) is server.url + KIWIX_ROOT_PATH.
+@contextmanager
+def serve_kiwix(latency=0.01, failure_rate=0.0, filler_sections=12):
+    with _serve(
+        _KiwixHandler, latency, failure_rate, filler_sections=filler_sections
+    ) as server:
+        yield server
+
+
+# Runs a stand-in for IMDB's dataset downloads, serving the given files (by name) from the
+# root of server.url. Yields the server, which counts the files it sent in full in
+# server.downloads. Call server.publish(name, data) to publish a new version of a file.
+@contextmanager
+def serve_datasets(files, latency=0.05, failure_rate=0.0):
+    with _serve(
+        _DatasetsHandler, latency, failure_rate, files={}, downloads=0
+    ) as server:
+        # Every version is published a day after the last one
+        clock = iter(range(1_600_000_000, 2_000_000_000, 86400))
+
+        def publish(name, data):
+            etag = f'"{hashlib.md5(data).hexdigest()}"'
+            with server.lock:
+                server.files[name] = (data, etag, next(clock))
+
+        server.publish = publish
+        for name, data in files.items():
+            publish(name, data)
+        yield server
+
+
+# Runs a stand-in for TMDB's API, which allows up to rate requests per second with the given
+# API key. Yields the server, whose API root is server.url + "/3", and which counts the
+# requests it throttled in server.throttled.
+@contextmanager
+def serve_tmdb(latency=0.1, failure_rate=0.0, rate=50, api_key="test"):
+    with _serve(
+        _TmdbHandler,
+        latency,
+        failure_rate,
+        rate=rate,
+        api_key=api_key,
+        recent=collections.deque(),
+        throttled=0,
+    ) as server:
+        yield server
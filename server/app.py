@@ -1,77 +1,323 @@
-from flask import Flask, request, g
-from model import init_model, get_movie_similarity_scores
+from flask import Flask, Response, request
+from model import (
+    init_model,
+    init_movie_filters,
+    movie_filters_stale,
+    select_similar_tconsts,
+    iter_batch_similar_tconsts,
+    get_model_version,
+)
 from dummy import dummy_movie, dummy_similar
-import sqlite3, pickle, time
+from resources import ConnectionPool, SharedPickle, file_version
+from cache import LRUCache
+from encoding import encode, negotiate_mimetype
+import atexit, functools, hashlib, json, threading, time
 
 
 # Change these if you are using different locations for the data files!
 IMDB_DB = "imdb.db"
 WIKIPEDIA_DB = "wikipedia.p"
 
+# Fields of a movie, as returned by lookup_movie, and the column of the titles table each
+# of them is built from
+FIELD_COLUMNS = {
+    "tconst": "tconst",
+    "title": "title",
+    "adult": "adult",
+    "year": "year",
+    "runtime": "runtime",
+    "genres": "genres",
+    "region": "region",
+    "directors": "directors",
+    "directorNames": "directors",
+    "writers": "writers",
+    "writerNames": "writers",
+    "rating": "rating",
+    "ratingVotes": "ratingVotes",
+    "poster": "poster",
+}
+MOVIE_FIELDS = tuple(FIELD_COLUMNS)
+
+# Denormalised table of movies written by newer versions of gen_imdb_db.py, with the names
+# of their directors/writers already resolved. Movies are read from it instead of titles and
+# names when imdb.db has it.
+SERVING_TABLE = "movies_serving"
+
+# Maximum number of tconsts in a single request to the batch endpoints
+MAX_BATCH_SIZE = 1000
+
+# Maximum number of parameters bound to a single SQLite query
+SQLITE_MAX_VARIABLES = 900
+
+# Maximum number of open (read-only) connections to the IMDB database
+IMDB_POOL_SIZE = 8
+
+# Bounds on the cache of looked up movies (set either to None for no bound)
+MOVIE_CACHE_MAX_ENTRIES = 20000
+MOVIE_CACHE_MAX_BYTES = None
+
+# Bound on the total size of cached /movie and /similar response bodies, in bytes
+RESPONSE_CACHE_MAX_BYTES = 64 * 2**20
+
+# How long clients may reuse /movie and /similar responses before revalidating, in seconds
+RESPONSE_MAX_AGE = 300
+
 app = Flask("app")
 
+
+# Caches the responses of a GET endpoint that is a pure function of its query parameters,
+# the loaded model, and the IMDB database. Successful responses are cached server-side by
+# request parameters, and are tagged with a strong ETag and Cache-Control headers, so that
+# repeat requests can be answered with 304 Not Modified (see after_request).
+def cached_response(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version = (get_model_version(), check_imdb_version())
+        response_cache.validate(version)
+
+        key = (
+            request.path,
+            tuple(sorted(request.args.items(multi=True))),
+            negotiate_mimetype(request.accept_mimetypes),
+        )
+        cached = response_cache.get(key)
+        if cached is None:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            body = response.get_data()
+            etag = hashlib.sha256(body).hexdigest()
+            cached = (body, response.mimetype, etag)
+            response_cache.put(key, cached, version)
+
+        body, mimetype, etag = cached
+        response = Response(body, mimetype=mimetype)
+        response.vary.add("Accept")
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = RESPONSE_MAX_AGE
+        return response
+
+    return wrapper
+
+
+# Encodes data as the best format the client accepts (see encoding.py): JSON by default,
+# or MessagePack for clients that ask for application/msgpack
+def make_data_response(data):
+    mimetype = negotiate_mimetype(request.accept_mimetypes)
+    response = Response(encode(data, mimetype), mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
+
+
 # GET /movie?tconst=<some tconst>` returns information about a single movie,
 # including its title, poster, and other metadata.
+# Accepts an optional fields parameter (see parse_fields).
 @app.route("/movie")
+@cached_response
 def get_movie():
     # Invalid request
     if "tconst" not in request.args:
         return "You need to include a tconst!", 400
+    try:
+        fields = parse_fields()
+    except ValueError:
+        return "Invalid request!", 400
 
     # Get movie identifier
     tconst = request.args["tconst"]
 
     # Lookup and return the movie
     try:
-        return lookup_movie(tconst), 200
+        movie = lookup_movie(tconst, fields)
     except:
         return "Oops!", 500
 
+    if movie is None:
+        return "Unknown movie!", 404
+    return make_data_response(movie)
+
 
 @app.route("/similar")
+@cached_response
 def get_similar():
 
     # Invalid request
     if "tconst" not in request.args:
         return "Invalid request!", 400
 
-    # Parse limit, if provided
-    limit = None
-    if "limit" in request.args:
-        try:
-            limit = int(request.args["limit"])
-        except:
-            return "Invalid request!", 400
+    # Parse limit and fields, if provided
+    try:
+        limit = parse_limit()
+        fields = parse_fields()
+    except ValueError:
+        return "Invalid request!", 400
 
     # Extract title ID
     tconst = request.args["tconst"]
 
-    # Lookup this movie
-    movie = lookup_movie(tconst)
+    # Lookup this movie, which only needs its tconst
+    movie = lookup_movie(tconst, ["tconst"])
+    if movie is None:
+        return "Unknown movie!", 404
 
-    # Get [(tconst, similarity score)] list from model
-    similarity_scores = get_movie_similarity_scores(tconst)
+    return make_data_response(find_similar_movies(movie, limit, fields))
 
-    # Remap tconsts --> movie info
-    similar_movies_all = list(map(lambda e: lookup_movie(e[0]), similarity_scores))
-    similar_movies_directorwriter = []
-    similar_movies_genre = []
 
-    # Build similar movie list for same director/writer and genre
-    for similar_movie in similar_movies_all:
-        if any(x in movie["directors"] for x in similar_movie["directors"]) or any(
-            x in movie["writers"] for x in similar_movie["writers"]
-        ):
-            similar_movies_directorwriter.append(similar_movie)
+# GET /movie_and_similar?tconst=<some tconst>&limit=<some num>&fields=<field,...> returns
+# both the information about a single movie (see /movie) and its lists of similar movies
+# (see /similar) in one response, looking up the movie itself only once.
+@app.route("/movie_and_similar")
+@cached_response
+def get_movie_and_similar():
+    # Invalid request
+    if "tconst" not in request.args:
+        return "Invalid request!", 400
 
-        if any(x in movie["genres"] for x in similar_movie["genres"]):
-            similar_movies_genre.append(similar_movie)
+    # Parse limit and fields, if provided
+    try:
+        limit = parse_limit()
+        fields = parse_fields()
+    except ValueError:
+        return "Invalid request!", 400
 
-    return {
-        "all": similar_movies_all[:limit],
-        "directorwriter": similar_movies_directorwriter[:limit],
-        "genre": similar_movies_genre[:limit],
-    }
+    # Lookup this movie, with the requested fields and the tconst to find similar movies
+    movie_fields = None if fields is None else list(dict.fromkeys(["tconst", *fields]))
+    movie = lookup_movie(request.args["tconst"], movie_fields)
+    if movie is None:
+        return "Unknown movie!", 404
+
+    return make_data_response(
+        {
+            "movie": project_movie(movie, fields),
+            "similar": find_similar_movies(movie, limit, fields),
+        }
+    )
+
+
+# Parses the optional limit query parameter, returning None if it wasn't provided.
+# Raises a ValueError if it isn't a non-negative integer.
+def parse_limit():
+    if "limit" not in request.args:
+        return None
+
+    limit = int(request.args["limit"])
+    if limit < 0:
+        raise ValueError(f"Invalid limit: {limit}")
+    return limit
+
+
+# Parses the optional fields query parameter, a comma-separated list of movie fields
+# (e.g. tconst,title,poster,rating) to include in every returned movie. Returns None if it
+# wasn't provided, meaning all fields. Raises a ValueError if any field isn't a movie field.
+def parse_fields(fields=None):
+    if fields is None:
+        if "fields" not in request.args:
+            return None
+        fields = request.args["fields"].split(",")
+
+    fields = list(dict.fromkeys(fields))
+    for field in fields:
+        if field not in MOVIE_FIELDS:
+            raise ValueError(f"Invalid field: {field}")
+    return fields
+
+
+# Returns a movie with only the given fields (or all of them if fields is None)
+def project_movie(movie, fields=None):
+    if fields is None:
+        return movie
+
+    return {field: movie[field] for field in fields}
+
+
+# POST /movies returns information about several movies at once. The request body is a JSON
+# object {"tconsts": [...], "fields": [...]} where fields is optional (see parse_fields),
+# and the response maps each tconst to its movie (or null).
+@app.route("/movies", methods=["POST"])
+def get_movies():
+    body = parse_batch_request()
+    if body is None:
+        return f"Invalid request! Expected at most {MAX_BATCH_SIZE} tconsts.", 400
+
+    tconsts, fields = body["tconsts"], body["fields"]
+    movies = lookup_movies(tconsts, fields)
+    return make_data_response({tconst: movies.get(tconst) for tconst in tconsts})
+
+
+# POST /similar/batch returns the lists of similar movies (see /similar) for several movies
+# at once. The request body is a JSON object {"tconsts": [...], "limit": <some num>,
+# "fields": [...]} where limit and fields are optional, and the response maps each tconst to
+# its lists of similar movies (or null). The model scores all of the movies together, and all
+# of the similar movies are looked up at once.
+@app.route("/similar/batch", methods=["POST"])
+def get_similar_batch():
+    body = parse_batch_request()
+    if body is None:
+        return f"Invalid request! Expected at most {MAX_BATCH_SIZE} tconsts.", 400
+
+    # Parse limit, if provided
+    tconsts, limit, fields = body["tconsts"], body.get("limit"), body["fields"]
+    if limit is not None and (type(limit) is not int or limit < 0):
+        return "Invalid request!", 400
+
+    # Select the similar tconsts of every movie, then look them all up at once
+    base_movies = lookup_movies(tconsts, ["tconst"])
+    similar_tconsts = dict(iter_batch_similar_tconsts(list(base_movies), limit))
+
+    movies = lookup_movies(
+        [
+            similar_tconst
+            for lists in similar_tconsts.values()
+            for tconsts in lists.values()
+            for similar_tconst in tconsts
+        ],
+        fields,
+    )
+
+    return make_data_response(
+        {
+            tconst: (
+                hydrate_similar_tconsts(similar_tconsts[tconst], movies)
+                if tconst in similar_tconsts
+                else None
+            )
+            for tconst in tconsts
+        }
+    )
+
+
+# Parses the JSON body of a batch request, removing any duplicate tconsts and parsing its
+# optional list of fields. Returns None if the body isn't a JSON object with a list of at
+# most MAX_BATCH_SIZE tconsts, or has invalid fields.
+def parse_batch_request():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("tconsts"), list):
+        return None
+
+    tconsts = body["tconsts"]
+    if len(tconsts) > MAX_BATCH_SIZE or not all(isinstance(t, str) for t in tconsts):
+        return None
+    body["tconsts"] = list(dict.fromkeys(tconsts))
+
+    fields = body.get("fields")
+    if fields is not None and (
+        not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)
+    ):
+        return None
+    try:
+        body["fields"] = parse_fields(fields) if fields is not None else None
+    except ValueError:
+        return None
+
+    return body
+
+
+# GET /stats returns hit/miss/eviction statistics for the server's caches
+@app.route("/stats")
+def get_stats():
+    return {"movieCache": movie_cache.stats(), "responseCache": response_cache.stats()}
 
 
 # Dummy endpoint for /movie which doesn't require a database
@@ -86,111 +332,239 @@ def get_dummy_similar():
     return dummy_similar
 
 
+# Builds the lists of similar movies (in general, by the same director/writer, and in the
+# same genre) for a movie, each holding at most limit movies (or all of them if limit is None).
+# The model selects the tconsts of all three lists from its precomputed genre/person filters
+# (see select_similar_tconsts in model.py) without touching the database, and the selected
+# movies are then looked up all at once, with just the given fields (see lookup_movies).
+def find_similar_movies(movie, limit=None, fields=None):
+    check_imdb_version()
+    similar_tconsts = select_similar_tconsts(movie["tconst"], limit)
+
+    # Only now look up the full movie info
+    movies = lookup_movies(
+        [tconst for tconsts in similar_tconsts.values() for tconst in tconsts], fields
+    )
+
+    return hydrate_similar_tconsts(similar_tconsts, movies)
+
+
+# Maps lists of similar tconsts to lists of movies, given a dictionary of tconst -> movie
+def hydrate_similar_tconsts(similar_tconsts, movies):
+    return {
+        name: [movies[tconst] for tconst in tconsts if tconst in movies]
+        for name, tconsts in similar_tconsts.items()
+    }
+
+
+# Reads the genres, directors, and writers of every movie in the database, to build the
+# model's metadata filters from (see init_movie_filters in model.py)
+def query_movie_filters():
+    with imdb_pool.connection() as imdb:
+        return imdb.execute(
+            "SELECT tconst, genres, directors, writers from titles"
+        ).fetchall()
+
+
+# Returns whether the IMDB database behind a connection has a SERVING_TABLE. This is asked
+# of the connection that is about to be queried, rather than remembered per version of
+# imdb.db, since imdb.db can be replaced between checking its version and connecting to it.
+def query_has_serving_table(imdb):
+    return (
+        imdb.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+            (SERVING_TABLE,),
+        ).fetchone()
+        is not None
+    )
+
+
 # Looks up a movie in the database and returns the (parsed) information in a dictionary.
-def lookup_movie(tconst):
-    # Execute query against local database to get the movie info
-    imdb, _ = get_dbs()
-    cur = imdb.cursor()
-    cur.execute("SELECT * from titles WHERE tconst=?", [tconst])
-    rows = cur.fetchall()
-    if len(rows) != 1:  # No entry for this movie
-        return None
+def lookup_movie(tconst, fields=None):
+    return lookup_movies([tconst], fields).get(tconst)
+
+
+# Looks up several movies in the database at once and returns a dictionary of
+# tconst -> (parsed) movie information, in the same order as tconsts. Movies that are not
+# in the database are left out. If fields is given, each movie only has those fields, and
+# only the columns and names needed for them are queried. Movies are served from movie_cache
+# where possible, and the rest take a fixed number of queries per SQLITE_MAX_VARIABLES
+# movies: one for the titles, and one for the names of all of their directors/writers (or
+# just one per SQLITE_MAX_VARIABLES movies if imdb.db has a SERVING_TABLE).
+def lookup_movies(tconsts, fields=None):
+    version = check_imdb_version()
+    fields = tuple(fields) if fields is not None else MOVIE_FIELDS
+    tconsts = list(tconsts)
+    unique_tconsts = list(dict.fromkeys(tconsts))
+
+    # Full movies are cached by tconst, and projected movies by (tconst, fields)
+    key = (
+        (lambda tconst: tconst)
+        if fields == MOVIE_FIELDS
+        else (lambda tconst: (tconst, fields))
+    )
+    cached = movie_cache.get_many(map(key, unique_tconsts))
+    movies = {
+        tconst: cached[key(tconst)]
+        for tconst in unique_tconsts
+        if key(tconst) in cached
+    }
+    missing = [tconst for tconst in unique_tconsts if tconst not in movies]
+
+    if len(missing) > 0:
+        for tconst, movie in query_movies(missing, fields).items():
+            movie_cache.put(key(tconst), movie, version)
+            movies[tconst] = movie
+
+    return {tconst: movies[tconst] for tconst in tconsts if tconst in movies}
+
+
+# Queries several movies from the database, with just the given fields (see lookup_movies)
+def query_movies(tconsts, fields=MOVIE_FIELDS):
+    rows = {}
+    names = {}
+    with imdb_pool.connection() as imdb:
+        cur = imdb.cursor()
+
+        # The serving table has a column for every field, names included
+        if query_has_serving_table(imdb):
+            table = SERVING_TABLE
+            columns = list(dict.fromkeys(["tconst", *fields]))
+            name_columns = []
+        else:
+            table = "titles"
+            columns = list(
+                dict.fromkeys(["tconst", *(FIELD_COLUMNS[field] for field in fields)])
+            )
+            name_columns = [
+                column
+                for field, column in (
+                    ("directorNames", "directors"),
+                    ("writerNames", "writers"),
+                )
+                if field in fields
+            ]
+
+        # Execute query against local database to get the movie info
+        for chunk in chunks(tconsts, SQLITE_MAX_VARIABLES):
+            params = ",".join("?" * len(chunk))
+            cur.execute(
+                f"SELECT {','.join(columns)} from {table} WHERE tconst IN ({params})",
+                chunk,
+            )
+            for row in cur.fetchall():
+                rows[row[0]] = dict(zip(columns, row))
+
+        # Extract actual names of directors/writers via nconsts, all at once
+        nconsts = set()
+        for row in rows.values():
+            for column in name_columns:
+                nconsts.update(row[column].split(","))
+
+        for chunk in chunks(list(nconsts), SQLITE_MAX_VARIABLES):
+            params = ",".join("?" * len(chunk))
+            cur.execute(
+                f"SELECT nconst, name from names WHERE nconst IN ({params})", chunk
+            )
+            names.update(cur.fetchall())
+
+    return {
+        tconst: parse_movie(rows[tconst], names, fields)
+        for tconst in tconsts
+        if tconst in rows
+    }
+
 
-    # Extract result
-    (
-        tconst,
-        title,
-        adult,
-        year,
-        runtime,
-        genres,
-        region,
-        directors,
-        writers,
-        rating,
-        ratingVotes,
-        poster,
-    ) = rows[-1]
+# Parses a row of the titles table or SERVING_TABLE (as a dictionary of column -> value) into
+# a dictionary with the given fields, given a dictionary of nconst -> name
+def parse_movie(row, names, fields=MOVIE_FIELDS):
+    movie = dict(row)
 
     # Cast adult field from 0/1 to bool
-    adult = bool(int(adult))
+    if "adult" in movie:
+        movie["adult"] = bool(int(movie["adult"]))
 
     # Genres, directors, and writers are comma-delimited strings,
     # so we'll split them into lists
-    genres = genres.split(",")
-    directors = directors.split(",")
-    writers = writers.split(",")
-
-    # Extract actual names of directors/writers via nconsts
-    def lookup_name(nconst):
-        cur.execute("SELECT * from names WHERE nconst=?", [nconst])
-        rows = cur.fetchall()
-        if len(rows) < 1:
-            return ""
-        # Extract and return result
-        nconst, name, birthYear, deathYear, profession, titles = rows[-1]
-        return name
-
-    director_names = list(map(lookup_name, directors))
-    writer_names = list(map(lookup_name, writers))
+    for column in ("genres", "directors", "writers"):
+        if column in movie:
+            movie[column] = movie[column].split(",")
+
+    # Map directors/writers to their actual names, unless the row already has them (as
+    # JSON lists)
+    for field, column in (("directorNames", "directors"), ("writerNames", "writers")):
+        if field in movie:
+            movie[field] = json.loads(movie[field])
+        elif field in fields:
+            movie[field] = [names.get(nconst, "") for nconst in movie[column]]
 
     # Return parsed dictionary
-    return {
-        "tconst": tconst,
-        "title": title,
-        "adult": bool(int(adult)),
-        "year": year,
-        "runtime": runtime,
-        "genres": genres,
-        "region": region,
-        "directors": directors,
-        "directorNames": director_names,
-        "writers": writers,
-        "writerNames": writer_names,
-        "rating": rating,
-        "ratingVotes": ratingVotes,
-        "poster": poster,
-    }
+    return {field: movie[field] for field in fields}
 
 
-# Returns singleton instances of the IMDB Sqlite3 database and Wikipedia dictionary,
-# and stores them on the global application context.
-def get_dbs():
-    imdb = getattr(g, "_imdb", None)
-    if imdb is None:
-        imdb = g._imdb = load_imdb()
-    wikipedia = getattr(g, "_wikipedia", None)
-    if wikipedia is None:
-        wikipedia = g._wikipedia = load_wikipedia()
+# Splits a list into consecutive chunks of at most size elements
+def chunks(items, size):
+    return [items[i : i + size] for i in range(0, len(items), size)]
 
-    return imdb, wikipedia
 
+# Process-wide handles for the IMDB Sqlite3 database and Wikipedia dictionary,
+# shared by every request. Both are only opened/loaded once they are first needed.
+imdb_pool = ConnectionPool(IMDB_DB, IMDB_POOL_SIZE)
+wikipedia_data = SharedPickle(WIKIPEDIA_DB)
 
-# Loading helpers for IMDB/Wikipedia datasets
-load_imdb = lambda: sqlite3.connect(IMDB_DB)
-load_wikipedia = lambda: pickle.load(open(WIKIPEDIA_DB, "rb"))
+# Automatically close the DB connections on application exit
+atexit.register(imdb_pool.close)
 
-# Automatically close the DB connection on application exit
-@app.teardown_appcontext
-def close_connection(_):
-    db = getattr(g, "_imdb", None)
-    if db is not None:
-        db.close()
+# Process-wide cache of looked up movies, tied to the version of the IMDB database
+movie_cache = LRUCache(MOVIE_CACHE_MAX_ENTRIES, MOVIE_CACHE_MAX_BYTES)
 
-#add CORS passthrough after request
-@app.after_request # blueprint can also be app~~
+# Held while switching over to a new version of the IMDB database or the model
+imdb_swap_lock = threading.Lock()
+
+# Process-wide cache of response bodies, tied to the versions of the model and IMDB database
+response_cache = LRUCache(
+    max_bytes=RESPONSE_CACHE_MAX_BYTES, sizeof=lambda cached: len(cached[0])
+)
+
+
+# Invalidates the movie cache and reopens the IMDB connections whenever imdb.db changes,
+# and rebuilds the model's metadata filters whenever imdb.db or the model changes. Returns
+# the version of imdb.db that is in use. The whole switch-over happens under
+# imdb_swap_lock, and the movie cache only moves to the new version once it is complete,
+# so concurrent requests wait for it instead of seeing half of it.
+def check_imdb_version():
+    version = file_version(IMDB_DB)
+    if version == movie_cache.version and not movie_filters_stale():
+        return version
+
+    with imdb_swap_lock:
+        # Another request may have switched over while we were waiting
+        if version != movie_cache.version:
+            imdb_pool.reset()
+            init_movie_filters(query_movie_filters())
+            movie_cache.validate(version)
+        elif movie_filters_stale():
+            init_movie_filters(query_movie_filters())
+    return version
+
+
+# add CORS passthrough after request
+@app.after_request  # blueprint can also be app~~
 def after_request(response):
     header = response.headers
-    header['Access-Control-Allow-Origin'] = '*'
+    header["Access-Control-Allow-Origin"] = "*"
+
+    # Answer conditional GETs for responses with an ETag (see cached_response)
+    if response.get_etag()[0] is not None:
+        response.make_conditional(request)
     return response
 
+
 if __name__ == "__main__":
     # Initialize the similarity model, then start the server
-    with app.app_context():
-        start = time.time()
-        print("Initializing similarity model...", end=" ", flush=True)
-        _, wikipedia = get_dbs()
-        init_model(wikipedia)
-        print(f"Done [{(time.time() - start):.1f}s]")
+    start = time.time()
+    print("Initializing similarity model...", end=" ", flush=True)
+    init_model(wikipedia_data.get())
+    print(f"Done [{(time.time() - start):.1f}s]")
 
     app.run()
@@ -0,0 +1,102 @@
+import sys, threading
+from collections import OrderedDict
+
+
+# A thread-safe least-recently-used cache, bounded by its number of entries and/or
+# the (approximate) number of bytes held by its values. Keeps hit, miss and eviction
+# counters, and can be tied to a version (e.g. of the database it caches) so that
+# it is cleared whenever that version changes.
+class LRUCache:
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or deep_sizeof
+        self.version = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    # Returns the cached value for key, or default if it isn't cached
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    # Returns a dictionary of key -> value for the keys that are cached
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key][0]
+                else:
+                    self.misses += 1
+        return found
+
+    # Caches value under key, evicting the least recently used entries if needed. If
+    # version is given, value is only cached if the cache is still at that version, so that
+    # values computed from data that has since changed are dropped.
+    def put(self, key, value, version=None):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries)
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    # Removes every entry
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # Clears the cache if version differs from the version it was last validated with.
+    # Returns whether the cache was cleared.
+    def validate(self, version):
+        with self._lock:
+            if version == self.version:
+                return False
+            self.version = version
+            self._entries.clear()
+            self._bytes = 0
+            return True
+
+    # Returns a dictionary of cache statistics
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes if self.max_bytes is not None else None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": self.hits / lookups if lookups > 0 else None,
+            }
+
+
+# Approximates the number of bytes held by a (JSON-like) object and everything it contains
+def deep_sizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item) for item in obj)
+    return size
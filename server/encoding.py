@@ -0,0 +1,39 @@
+import json
+
+# Optional faster encoders. Responses fall back to the standard library's JSON encoder
+# if orjson isn't installed, and MessagePack is only offered if msgpack is installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack")
+
+
+# Returns the mimetypes responses can be encoded as, in order of preference
+def supported_mimetypes():
+    if msgpack is None:
+        return [JSON_MIMETYPE]
+    return [JSON_MIMETYPE, *MSGPACK_MIMETYPES]
+
+
+# Picks the mimetype to encode a response as, given the request's Accept header
+# (as parsed by werkzeug). Defaults to JSON.
+def negotiate_mimetype(accept_mimetypes):
+    return accept_mimetypes.best_match(supported_mimetypes(), default=JSON_MIMETYPE)
+
+
+# Encodes data (dictionaries, lists, strings, numbers, booleans, and None) as mimetype
+def encode(data, mimetype=JSON_MIMETYPE):
+    if mimetype in MSGPACK_MIMETYPES:
+        return msgpack.packb(data, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
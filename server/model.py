@@ -1,112 +1,1305 @@
-import os, pickle, re, string, math
+import os, pickle, re, string, time, json, hashlib, shutil, tempfile
 import numpy as np
+import scipy.sparse
 from multiprocessing import Pool, cpu_count
 from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.preprocessing import normalize
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.decomposition import TruncatedSVD
 from sklearn.metrics.pairwise import cosine_similarity
 from bidict import bidict
 
 # from nltk.stem.porter import PorterStemmer
 
 
-# File to store pickled model resources in
-MODEL_FILE = "model_res.p"
+# Directory to store versioned model artifacts in. Each build of the model gets its own
+# subdirectory keyed on a hash of the Wikipedia dataset and the parameters below, so
+# artifacts are rebuilt automatically whenever one of these inputs changes.
+# Old subdirectories are never read again and can safely be deleted.
+MODEL_CACHE_DIR = "model_cache"
+
+# Bump this whenever the artifact layout changes
+ARTIFACT_VERSION = 1
+
+# Parameters of the preprocessing step. Bump "version" whenever _preprocess_wikipedia_entry
+# changes, so that previously preprocessed datasets are not reused. "tokenizer" is either:
+# - "nltk": NLTK's word_tokenize
+# - "regex": a single pass of precompiled regular expressions that mimics word_tokenize for
+#   the tokens we keep (see _fast_tokenize), which is several times faster. Check how closely
+#   it matches on your dataset with `python model.py preprocess [path to wikipedia.p]`.
+PREPROCESS_PARAMS = {"version": 1, "tokenizer": "nltk"}
+
+# Number of Wikipedia entries sent to each preprocessing worker at a time
+PREPROCESS_CHUNK_SIZE = 64
+
+# Keyword arguments for the TF-IDF vectorizer
+VECTORIZER_PARAMS = {}
+
+# How entries are turned into TF-IDF features:
+# - "vocabulary": fit a TfidfVectorizer (with VECTORIZER_PARAMS) on the whole corpus, so any
+#   change to the Wikipedia dataset means building the model from scratch
+# - "hashing": hash terms into a fixed space of HASHING_FEATURES features, and keep the raw
+#   term counts and document frequencies with the artifacts, so that a changed dataset is
+#   applied on top of the previous build (see _update_model_artifacts)
+FEATURES = "vocabulary"
+
+# Number of features terms are hashed into when FEATURES = "hashing". Terms that hash to
+# the same feature are counted together, so this should be well above the vocabulary size.
+HASHING_FEATURES = 2**22
+
+# Incremental updates fall back to a full build once more than this fraction of movies has
+# changed since the last full build, counted across all the updates in between
+MAX_INCREMENTAL_CHANGE = 0.5
+
+# How similarity scores are computed at query time:
+# - "dense": precompute the full n x n cosine similarity matrix (memory grows with n^2)
+# - "sparse": keep only the L2-normalised TF-IDF matrix and compute one row per query
+#   with a sparse mat-vec (memory grows with the number of non-zeros)
+# - "topk": serve the precomputed top-K neighbour table from memory-mapped files
+#   (see build_neighbour_table), falling back to building it if it does not exist yet
+# - "ann": like "sparse", but only score the candidates found by an approximate nearest
+#   neighbour index (see ANN_PARAMS), for corpora too large to scan every row of X per query
+# - "lsa": embed movies in a low-rank space (see LSA_PARAMS) and compute one row per query
+#   with a small dense mat-vec (memory grows with n times the number of dimensions)
+SIMILARITY_MODE = "sparse"
+
+# Parameters of the "lsa" mode. Movies are embedded in a "components"-dimensional space with
+# a truncated SVD of X (latent semantic analysis), and their L2-normalised embeddings are
+# stored as "dtype": either "float32", or "int8" with a scale per movie, for a quarter of
+# the memory at a small cost in accuracy.
+LSA_PARAMS = {"components": 256, "dtype": "float32", "seed": 0}
+
+# Parameters of the approximate nearest neighbour index used by the "ann" mode. This is an
+# IVF-style index: movies are projected down to "dimensions" dimensions with a sparse random
+# projection, and partitioned into "lists" clusters (4 sqrt(n) if None) with spherical
+# k-means, trained for "iterations" iterations on a sample of "sample" movies. A query only
+# scores the movies in the ANN_PROBES clusters nearest to it, of at most "max_probes".
+# More dimensions partition the movies more accurately, and more lists make each list
+# (and so each probe) smaller.
+ANN_PARAMS = {
+    "dimensions": 256,
+    "lists": None,
+    "sample": 65536,
+    "iterations": 10,
+    "max_probes": 32,
+    "seed": 0,
+}
+
+# Number of clusters scored per query by the "ann" mode. More probes find more of the true
+# neighbours (higher recall) but score more candidates (higher latency), and can be changed
+# without rebuilding the index. Run `python model.py ann [path to wikipedia.p]` to compare
+# the recall and latency of different numbers of probes.
+ANN_PROBES = 8
+
+# Number of neighbours kept for each movie in the neighbour table. In "topk" mode the
+# "directorwriter" and "genre" lists are filtered from just these neighbours.
+NEIGHBOURS_K = 500
+
+# Number of rows of M each worker computes at once while building the neighbour table
+NEIGHBOURS_BLOCK_SIZE = 256
+
+# Number of rows of M computed at once when scoring several movies at the same time
+SIMILARITY_BLOCK_SIZE = 64
+
+# Names of the lists of similar movies returned by select_similar_tconsts
+SIMILAR_LISTS = ("all", "directorwriter", "genre")
 
 # Global variable to store model
 _model = None
 
+# Global variable to store the metadata filters of the model (see init_movie_filters)
+_filters = None
+
 # Returns the a list of [(tconst, similarity_score)]
-# in descending sorted order of similarity score
-def get_movie_similarity_scores(tconst):
+# in descending sorted order of similarity score.
+# At most k movies are returned (all of them if k is None), and only movies
+# with a similarity score greater than min_score are included.
+def get_movie_similarity_scores(tconst, k=None, min_score=0):
     global _model
     if _model is None:
         return None
 
     # Unpack model
-    tconst_map, similarity_matrix, wikipedia = _model
-
-    # Lookup this movie in the similarity table
-    similarity = similarity_matrix[tconst_map[tconst]]
+    tconst_map = _model["tconst_map"]
+    i = tconst_map[tconst]
 
-    # Reverse argsort to find the indices of the movies that are most similar
-    similarity_idxs = np.argsort(similarity).flatten()[::-1]
+    # Neighbour table rows are already sorted, exclude the movie itself,
+    # and are padded with -1 once the movie runs out of non-zero neighbours
+    if _model["mode"] == "topk":
+        neighbours = np.asarray(_model["neighbour_idxs"][i][:k])
+        scores = np.asarray(_model["neighbour_scores"][i][:k])
+        keep = (neighbours >= 0) & (scores > min_score)
+        neighbours, scores = neighbours[keep], scores[keep]
+    # Otherwise select the top k from this movie's row in the similarity table
+    else:
+        similarity = _similarity_row(_model, i)
+        neighbours = _top_k(similarity, k, min_score, exclude=i)
+        scores = similarity[neighbours]
 
     # Map to list of (tconst, similarity_score)
-    result = map(lambda i: (tconst_map.inverse[i], similarity[i]), similarity_idxs)
+    return [
+        (tconst_map.inverse[j], score)
+        for j, score in zip(neighbours.tolist(), scores.tolist())
+    ]
+
+
+# Returns the version of the loaded model, which changes whenever its artifacts do
+def get_model_version():
+    global _model
+    if _model is None:
+        return None
+
+    return _model["version"]
+
+
+# Returns the indices of the (at most) k largest entries of a similarity row that are
+# greater than min_score, in descending order of score, leaving out index exclude.
+# Candidates are selected with argpartition, so only the selected slice is sorted.
+def _top_k(similarity, k=None, min_score=0, exclude=None):
+    candidates = np.flatnonzero(similarity > min_score)
+    if exclude is not None:
+        candidates = candidates[candidates != exclude]
+
+    if k is not None and k < len(candidates):
+        if k <= 0:
+            return candidates[:0]
+        selected = np.argpartition(-similarity[candidates], k - 1)[:k]
+        candidates = candidates[selected]
+
+    order = np.argsort(-similarity[candidates], kind="stable")
+    return candidates[order]
+
+
+# Returns the lists of similar movies for a movie as a dictionary of list name -> [tconst],
+# each in descending sorted order of similarity score: all similar movies ("all"), those that
+# share a director or writer with the movie ("directorwriter"), and those that share a genre
+# with it ("genre"). Each list holds at most limit movies (all of them if limit is None), and
+# only movies with a similarity score greater than min_score that are in the titles table are
+# included. The lists are filtered with NumPy masks over the movie's whole row of candidates
+# (see init_movie_filters), so the filtered lists cost about the same as the unfiltered one.
+# In "topk" mode the row only holds the movie's NEIGHBOURS_K nearest neighbours, so the
+# filtered lists can be shorter than limit (or empty) even when more movies with a score
+# above min_score match. Movies that are not in the model get empty lists.
+def select_similar_tconsts(tconst, limit=None, min_score=0):
+    global _model
+    filters = _get_movie_filters()
+    i = _model["tconst_map"].get(tconst) if _model is not None else None
+    if i is None:
+        return {name: [] for name in SIMILAR_LISTS}
+
+    similarity = None if _model["mode"] == "topk" else _similarity_row(_model, i)
+    return _select_similar_tconsts(_model, filters, i, similarity, limit, min_score)
+
+
+# Like select_similar_tconsts, but for several movies at once. Lazily yields (tconst, lists)
+# pairs in the same order as tconsts, computing the rows of M for SIMILARITY_BLOCK_SIZE
+# movies at a time with a single sparse mat-mat product.
+def iter_batch_similar_tconsts(tconsts, limit=None, min_score=0):
+    global _model
+    filters = _get_movie_filters()
+    if _model is None:
+        for tconst in tconsts:
+            yield tconst, {name: [] for name in SIMILAR_LISTS}
+        return
+
+    tconst_map = _model["tconst_map"]
+    for block in range(0, len(tconsts), SIMILARITY_BLOCK_SIZE):
+        block_tconsts = tconsts[block : block + SIMILARITY_BLOCK_SIZE]
+        idxs = [tconst_map.get(tconst) for tconst in block_tconsts]
+
+        # Compute all rows of this block at once
+        similarities = None
+        known = [i for i in idxs if i is not None]
+        if _model["mode"] != "topk" and len(known) > 0:
+            similarities = dict(zip(known, _similarity_rows(_model, known)))
+
+        for tconst, i in zip(block_tconsts, idxs):
+            if i is None:
+                yield tconst, {name: [] for name in SIMILAR_LISTS}
+            else:
+                similarity = similarities[i] if similarities is not None else None
+                yield tconst, _select_similar_tconsts(
+                    _model, filters, i, similarity, limit, min_score
+                )
+
+
+# Selects the lists of similar movies for movie i (see select_similar_tconsts),
+# given its row of M (or None if the model has a neighbour table)
+def _select_similar_tconsts(model, filters, i, similarity, limit, min_score):
+    tconst_map = model["tconst_map"]
+
+    # Neighbour table rows are already sorted, so every list is a prefix of its matches.
+    # Only the top NEIGHBOURS_K movies are candidates, which limits the filtered lists.
+    if model["mode"] == "topk":
+        candidates = np.asarray(model["neighbour_idxs"][i])
+        scores = np.asarray(model["neighbour_scores"][i])
+        candidates = candidates[(candidates >= 0) & (scores > min_score)]
+    # Otherwise every movie with a high enough score is a candidate
+    else:
+        candidates = np.flatnonzero(similarity > min_score)
+        candidates = candidates[candidates != i]
+    candidates = candidates[filters["in_db"][candidates]]
+
+    # Movies that share a director/writer with movie i, via its people's rows of the
+    # person -> movie incidence matrix
+    people = filters["movie_people"][i].indices
+    shares_person = np.zeros(len(tconst_map), dtype=bool)
+    shares_person[filters["person_movies"][people].indices] = True
+
+    masks = {
+        "all": np.ones(len(candidates), dtype=bool),
+        "directorwriter": shares_person[candidates],
+        "genre": (filters["genres"][candidates] & filters["genres"][i]) != 0,
+    }
+
+    similar = {}
+    for name in SIMILAR_LISTS:
+        matches = candidates[masks[name]]
+        if model["mode"] == "topk":
+            matches = matches[:limit]
+        else:
+            matches = matches[_top_k(similarity[matches], limit, min_score)]
+        similar[name] = [tconst_map.inverse[j] for j in matches.tolist()]
+
+    return similar
+
+
+# Precomputes the metadata filters used by select_similar_tconsts, aligned with the rows of
+# the loaded model, from (tconst, genres, directors, writers) rows of the titles table, where
+# the last three are comma-delimited strings. The filters are:
+# - in_db: whether each movie is in the titles table at all
+# - genres: a 64-bit mask of each movie's genres, one bit per distinct genre
+# - movie_people/person_movies: a sparse movie x person incidence matrix and its transpose,
+#   with a person for each (role, nconst) pair so that directors only match directors and
+#   writers only match writers
+# Call this after init_model, and again whenever the titles table changes.
+def init_movie_filters(rows):
+    global _model, _filters
+    if _model is None:
+        return
 
-    # Remove any entry where the similarity is zero
-    result = filter(lambda e: not math.isclose(e[1], 0), result)
+    tconst_map = _model["tconst_map"]
+    in_db = np.zeros(len(tconst_map), dtype=bool)
+    genres = np.zeros(len(tconst_map), dtype=np.uint64)
+    genre_bits = {}
+    people = {}
+    movie_idxs, person_idxs = [], []
 
-    # Remove the first entry, since that (should) be itself
-    next(result)
+    for tconst, movie_genres, directors, writers in rows:
+        i = tconst_map.get(tconst)
+        if i is None:
+            continue
+        in_db[i] = True
 
-    return list(result)
+        mask = 0
+        for genre in filter(None, movie_genres.split(",")):
+            if genre not in genre_bits:
+                if len(genre_bits) == 64:
+                    raise ValueError("Too many distinct genres for a 64-bit mask")
+                genre_bits[genre] = len(genre_bits)
+            mask |= 1 << genre_bits[genre]
+        genres[i] = mask
+
+        for role, nconsts in (("director", directors), ("writer", writers)):
+            for nconst in filter(None, nconsts.split(",")):
+                movie_idxs.append(i)
+                person_idxs.append(people.setdefault((role, nconst), len(people)))
+
+    movie_people = scipy.sparse.csr_matrix(
+        (np.ones(len(movie_idxs), dtype=np.int8), (movie_idxs, person_idxs)),
+        shape=(len(tconst_map), len(people)),
+    )
+    _filters = {
+        "tconst_map": tconst_map,
+        "in_db": in_db,
+        "genres": genres,
+        "movie_people": movie_people,
+        "person_movies": movie_people.T.tocsr(),
+    }
+
+
+# Returns whether the metadata filters need to be (re)built with init_movie_filters,
+# i.e. a model is loaded but the filters haven't been built for it yet
+def movie_filters_stale():
+    global _model, _filters
+    return _model is not None and (
+        _filters is None or _filters["tconst_map"] is not _model["tconst_map"]
+    )
+
+
+# Returns the metadata filters for the loaded model
+def _get_movie_filters():
+    if movie_filters_stale():
+        raise RuntimeError("init_movie_filters must be called after init_model")
+    return _filters
 
 
 # Initializes the similarity model into global memory
-def init_model(wikipedia):
+def init_model(wikipedia, mode=None):
     global _model
-    _model = _build_similarity_model(wikipedia)
+    mode = mode or SIMILARITY_MODE
+    artifact_dir = _get_model_artifacts(wikipedia)
+
+    if mode == "topk":
+        neighbours_dir = _neighbours_dir(artifact_dir, NEIGHBOURS_K)
+        if not os.path.exists(neighbours_dir):
+            build_neighbour_table(wikipedia, NEIGHBOURS_K)
+        _model = _load_neighbour_table(artifact_dir, neighbours_dir)
+    else:
+        _model = _load_similarity_model(artifact_dir, mode)
+
+
+# Initializes the model for a new version of the Wikipedia dataset, replacing the current one.
+# With hashed features (see FEATURES) the new model is built incrementally from the previous
+# build, so only new and changed entries are preprocessed. Returns what changed since that
+# build as a dictionary with the number of movies "added", "changed", and "removed" (and
+# "drift", the number of changes since the last full build), or None if the model was built
+# from scratch.
+def update_model(wikipedia, mode=None):
+    init_model(wikipedia, mode)
+
+    update_file = os.path.join(MODEL_CACHE_DIR, _model["version"], "update.json")
+    if not os.path.exists(update_file):
+        return None
+    with open(update_file) as f:
+        return json.load(f)
+
+
+# Returns row i of the similarity matrix M as a dense 1-d array
+def _similarity_row(model, i):
+    if model["mode"] == "dense":
+        return model["similarity_matrix"][i]
 
+    if model["mode"] == "lsa":
+        return _lsa_scores(model["lsa"], [i])[0]
+
+    # Only score the candidates from the ANN index, and leave every other score at 0
+    tfidf = model["tfidf"]
+    if model["mode"] == "ann":
+        candidates = _ann_candidates(model["ann"], i)
+        similarity = np.zeros(tfidf.shape[0])
+        similarity[candidates] = tfidf[candidates].dot(tfidf[i].toarray().ravel())
+        return similarity
+
+    # TF-IDF rows are L2-normalised, so cosine similarity is just a dot product.
+    # Densifying the query row first keeps this a single sparse mat-vec.
+    return tfidf.dot(tfidf[i].toarray().ravel())
+
+
+# Returns rows idxs of the similarity matrix M as a dense 2-d array
+def _similarity_rows(model, idxs):
+    if model["mode"] == "dense":
+        return model["similarity_matrix"][idxs]
+    if model["mode"] == "ann":
+        return np.array([_similarity_row(model, i) for i in idxs])
+    if model["mode"] == "lsa":
+        return _lsa_scores(model["lsa"], idxs)
+
+    tfidf = model["tfidf"]
+    return (tfidf[idxs] @ tfidf.T).toarray()
+
+
+# Returns the number of bytes held by the similarity data of a model
+def _model_nbytes(model):
+    if model["mode"] == "dense":
+        return model["similarity_matrix"].nbytes
+    if model["mode"] == "lsa":
+        return sum(array.nbytes for array in model["lsa"].values() if array is not None)
+
+    tfidf = model["tfidf"]
+    nbytes = tfidf.data.nbytes + tfidf.indices.nbytes + tfidf.indptr.nbytes
+    if model["mode"] == "ann":
+        nbytes += sum(
+            model["ann"][name].nbytes for name in ("nearest", "order", "offsets")
+        )
+    return nbytes
+
+
+# Builds every similarity mode over the same corpus and reports memory usage
+# and per-query latency side by side for a sample of n_queries movies
+def benchmark_similarity_modes(
+    wikipedia, n_queries=100, modes=("dense", "sparse", "lsa")
+):
+    results = {}
+    for mode in modes:
+        model = _build_similarity_model(wikipedia, mode)
+        n = len(model["tconst_map"])
+        rng = np.random.default_rng(0)
+        queries = rng.choice(n, size=min(n_queries, n), replace=False)
+
+        latencies = []
+        for i in queries:
+            start = time.perf_counter()
+            _top_k(_similarity_row(model, i), k=20, exclude=i)
+            latencies.append(time.perf_counter() - start)
+
+        latencies = np.array(latencies) * 1000
+        results[mode] = {
+            "bytes": _model_nbytes(model),
+            "mean_ms": float(latencies.mean()),
+            "p95_ms": float(np.percentile(latencies, 95)),
+        }
+        print(
+            f"{mode:>8}: {results[mode]['bytes'] / 2**20:10.1f} MiB, "
+            f"{results[mode]['mean_ms']:7.2f} ms/query (mean), "
+            f"{results[mode]['p95_ms']:7.2f} ms/query (p95)"
+        )
+
+    return results
+
+
+# Builds the similarity model for the given mode, reusing cached artifacts if possible.
+# For the "lsa" mode, also reports how much its scores differ from plain TF-IDF's.
+def _build_similarity_model(wikipedia, mode=SIMILARITY_MODE):
+    artifact_dir = _get_model_artifacts(wikipedia)
+    model = _load_similarity_model(artifact_dir, mode)
+
+    if mode == "lsa":
+        quality_file = os.path.join(_lsa_dir(artifact_dir, LSA_PARAMS), "quality.json")
+        with open(quality_file) as f:
+            quality = json.load(f)
+        if quality["recall"] is not None:
+            print(
+                f"lsa vs tf-idf: recall@{quality['k']} {quality['recall']:.3f}, "
+                f"mean absolute score error {quality['score_error']:.4f}"
+            )
+
+    return model
+
+
+# Loads the similarity model for the given mode from an artifact directory.
+# Returns a dictionary with the index->tconst map L and either:
+# - (dense) an n x n matrix M, where M[i][j] is the cosine similarity between L[i] and L[j]
+# - (sparse) the L2-normalised n x m TF-IDF matrix X, where M = X X^T is computed row by row
+# - (ann) X, and an ANN index of X (built first if it doesn't exist yet, see _build_ann_index)
+# - (lsa) the n x d embeddings E of the movies, where M ~ E E^T is computed row by row
+#   (built first if they don't exist yet, see _build_lsa_embeddings)
+def _load_similarity_model(artifact_dir, mode):
+    if mode not in ("dense", "sparse", "ann", "lsa"):
+        raise ValueError(f"Unknown similarity mode: {mode}")
+
+    model = {
+        "mode": mode,
+        "version": os.path.basename(artifact_dir),
+        "tconst_map": _load_tconst_map(artifact_dir),
+    }
+
+    # The embeddings replace X entirely
+    if mode == "lsa":
+        lsa_dir = _lsa_dir(artifact_dir, LSA_PARAMS)
+        if not os.path.exists(lsa_dir):
+            _build_lsa_embeddings(artifact_dir, LSA_PARAMS)
+        model["lsa"] = _load_lsa_embeddings(lsa_dir)
+        return model
+
+    tfidf = scipy.sparse.load_npz(os.path.join(artifact_dir, "tfidf.npz")).tocsr()
+
+    # Build cosine similarity matrix M using the entire corpus
+    if mode == "dense":
+        model["similarity_matrix"] = cosine_similarity(tfidf, tfidf)
+    # Keep just the sparse TF-IDF matrix, and compute rows of M on demand
+    else:
+        model["tfidf"] = tfidf
+
+    # Also load the ANN index, which picks the entries of each row of M to compute
+    if mode == "ann":
+        ann_dir = _ann_dir(artifact_dir, ANN_PARAMS)
+        if not os.path.exists(ann_dir):
+            _build_ann_index(artifact_dir, ANN_PARAMS)
+        model["ann"] = _load_ann_index(ann_dir)
+
+    return model
+
+
+# Loads the index->tconst list L of an artifact directory as a bidirectional map
+def _load_tconst_map(artifact_dir):
+    tconsts = np.load(os.path.join(artifact_dir, "tconsts.npy"))
+    return bidict({str(tconst): i for i, tconst in enumerate(tconsts)})
+
+
+# Returns the artifact directory for this Wikipedia dataset and the current parameters,
+# building it first if it doesn't exist yet. An artifact directory contains:
+# - vectorizer.p: the fitted TF-IDF vectorizer (vocabulary and IDF weights)
+# - tfidf.npz: the L2-normalised n x m TF-IDF matrix X
+# - tconsts.npy: the index->tconst list L
+# - neighbours-<k>/: top-k neighbour tables, if any have been built
+# With hashed features (see FEATURES) it also contains:
+# - counts.npz: the raw n x HASHING_FEATURES term count matrix
+# - df.npy: the document frequency of every feature
+# - entry_hashes.npy: a hash of each movie's raw Wikipedia entry, to detect changed entries
+# - update.json: what changed since the previous build, and how many movies changed since
+#   the last full build, if it was built incrementally
+# The preprocessed dataset is cached next to the artifact directories, keyed on just the
+# dataset and preprocessing parameters, so changing the vectorizer doesn't redo preprocessing
+def _get_model_artifacts(wikipedia):
+    preprocess_key = _hash_key(_hash_wikipedia(wikipedia), PREPROCESS_PARAMS)
+    model_key = _hash_key(ARTIFACT_VERSION, preprocess_key, _feature_params())
+    artifact_dir = os.path.join(MODEL_CACHE_DIR, model_key)
+    if os.path.exists(artifact_dir):
+        return artifact_dir
+
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+
+    # With hashed features, apply just the changes since the last build if we can
+    if FEATURES == "hashing":
+        base_dir = _latest_artifacts()
+        if base_dir is not None and _update_model_artifacts(
+            base_dir, wikipedia, artifact_dir
+        ):
+            _set_latest_artifacts(artifact_dir)
+            _prune_artifacts(_previous_artifacts(base_dir), artifact_dir)
+            return artifact_dir
+        entry_hashes = [_hash_entry(entry) for entry in wikipedia.values()]
 
-# Builds an n x n matrix M and corresponding index->tconst list L
-# M[i][j] is the cosine similarity between the tconsts L[i] and L[j]
-def _build_similarity_model(wikipedia):
     # Load the preprocessed Wikipedia dataset from file if we have it
-    if os.path.exists(MODEL_FILE):
-        wikipedia = pickle.load(open(MODEL_FILE, "rb"))
+    preprocessed_file = os.path.join(
+        MODEL_CACHE_DIR, f"preprocessed-{preprocess_key}.p"
+    )
+    if os.path.exists(preprocessed_file):
+        with open(preprocessed_file, "rb") as f:
+            wikipedia = pickle.load(f)
     # Otherwise, we need to make it ourselves
     else:
         wikipedia = _preprocess_wikipedia(wikipedia)
         # Dump post-processed Wikipedia dataset to file
-        with open(MODEL_FILE, "wb") as f:
+        tmp_file = f"{preprocessed_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
             pickle.dump(wikipedia, f)
+        os.replace(tmp_file, preprocessed_file)
 
     # Extract tconsts/entries to separate lists
     tconsts, entries = zip(*wikipedia.items())
     tconsts, entries = list(tconsts), list(entries)
 
-    # Build cosine similarity matrix M using the entire corpus
-    vectorizer = TfidfVectorizer()
-    entries_vectorized = vectorizer.fit_transform(entries)
-    similarity_matrix = cosine_similarity(entries_vectorized, entries_vectorized)
+    # Write everything to a temporary directory first, so that a crash never leaves
+    # behind a partially built artifact directory
+    tmp_dir = _make_tmp_dir(artifact_dir)
 
-    # Form index->tconst list L
-    tconst_map = bidict({tconst: i for tconst, i in zip(tconsts, range(len(tconsts)))})
+    # Vectorize the entire corpus (rows are L2-normalised by default)
+    if FEATURES == "hashing":
+        vectorizer = _hashing_vectorizer()
+        counts = vectorizer.transform(entries).tocsr()
+        df = np.bincount(counts.indices, minlength=HASHING_FEATURES)
+        entries_vectorized = _hashed_tfidf(counts, df)
+        scipy.sparse.save_npz(os.path.join(tmp_dir, "counts.npz"), counts)
+        np.save(os.path.join(tmp_dir, "df.npy"), df)
+        np.save(os.path.join(tmp_dir, "entry_hashes.npy"), np.array(entry_hashes))
+    else:
+        vectorizer = TfidfVectorizer(**VECTORIZER_PARAMS)
+        entries_vectorized = vectorizer.fit_transform(entries).tocsr()
 
-    return tconst_map, similarity_matrix, wikipedia
+    with open(os.path.join(tmp_dir, "vectorizer.p"), "wb") as f:
+        pickle.dump(vectorizer, f)
+    scipy.sparse.save_npz(os.path.join(tmp_dir, "tfidf.npz"), entries_vectorized)
+    np.save(os.path.join(tmp_dir, "tconsts.npy"), np.array(tconsts))
+    _move_into_place(tmp_dir, artifact_dir)
 
+    if FEATURES == "hashing":
+        _set_latest_artifacts(artifact_dir)
+        _prune_artifacts(base_dir, artifact_dir)
 
-# Preprocess the entire Wikipedia dataset in parallel
-def _preprocess_wikipedia(wikipedia):
-    # Parallel map the entry parser to generate a new, cleaned dataset
-    pool = Pool(processes=cpu_count())
-    wikipedia = {
-        tconst: entry
-        for (tconst, entry) in pool.map(_preprocess_wikipedia_entry, wikipedia.items())
-    }
+    return artifact_dir
+
+
+# Returns the parameters of the feature space that artifacts are keyed on
+def _feature_params():
+    if FEATURES == "vocabulary":
+        return VECTORIZER_PARAMS
+    if FEATURES == "hashing":
+        return {"features": FEATURES, "n_features": HASHING_FEATURES}
+    raise ValueError(f"Unknown features: {FEATURES}")
+
+
+# Returns a vectorizer that maps entries to raw term counts in the hashed feature space.
+# It tokenizes and lowercases exactly like TfidfVectorizer's defaults.
+def _hashing_vectorizer():
+    return HashingVectorizer(
+        n_features=HASHING_FEATURES, alternate_sign=False, norm=None
+    )
+
+
+# Computes the L2-normalised TF-IDF matrix X from raw term counts and document frequencies,
+# with the same (smoothed) IDF weights as TfidfVectorizer
+def _hashed_tfidf(counts, df):
+    idf = np.log((1 + counts.shape[0]) / (1 + df)) + 1
+    tfidf = counts.astype(np.float64)
+    tfidf.data *= idf[tfidf.indices]
+    return normalize(tfidf)
+
+
+# Returns a short hash of a single raw Wikipedia entry
+def _hash_entry(entry):
+    return hashlib.sha256(entry.encode()).hexdigest()[:16]
+
+
+# Returns the file that points to the latest artifact directory built with hashed features
+# and the current parameters, which the next incremental update starts from
+def _latest_artifacts_file():
+    key = _hash_key(ARTIFACT_VERSION, PREPROCESS_PARAMS, _feature_params())
+    return os.path.join(MODEL_CACHE_DIR, f"latest-{key}")
+
+
+# Returns the latest artifact directory built with hashed features, if there is one
+def _latest_artifacts():
+    try:
+        with open(_latest_artifacts_file()) as f:
+            artifact_dir = os.path.join(MODEL_CACHE_DIR, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+    return artifact_dir if os.path.exists(artifact_dir) else None
+
+
+# Marks an artifact directory as the latest one built with hashed features
+def _set_latest_artifacts(artifact_dir):
+    latest_file = _latest_artifacts_file()
+    tmp_file = f"{latest_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(os.path.basename(artifact_dir))
+    os.replace(tmp_file, latest_file)
+
+
+# Deletes an old artifact directory built with hashed features and every build it was
+# incrementally built from, up to artifact_dir. Every build holds a full copy of its
+# artifacts, so after an update only its base and the new build are kept, and a full
+# build replaces all of them.
+def _prune_artifacts(previous_dir, artifact_dir):
+    while previous_dir is not None and previous_dir != artifact_dir:
+        next_dir = _previous_artifacts(previous_dir)
+        shutil.rmtree(previous_dir, ignore_errors=True)
+        previous_dir = next_dir
+
+
+# Returns the artifact directory an incremental build was built from, if there is one
+def _previous_artifacts(artifact_dir):
+    try:
+        with open(os.path.join(artifact_dir, "update.json")) as f:
+            return os.path.join(MODEL_CACHE_DIR, json.load(f)["base"])
+    except FileNotFoundError:
+        return None
+
+
+# Builds artifact_dir for a new version of the Wikipedia dataset from the artifacts of a
+# previous build (base_dir) with hashed features. Only new and changed entries are
+# preprocessed and counted, the document frequencies are adjusted for just those entries
+# (and removed ones), and each neighbour table of base_dir is updated in place of a rebuild
+# (see _update_neighbour_table). Unchanged movies keep their order, and new movies are
+# added at the end. Returns False without writing anything if too much has changed since
+# the last full build for an incremental update to be worth it (see MAX_INCREMENTAL_CHANGE).
+def _update_model_artifacts(base_dir, wikipedia, artifact_dir):
+    old_tconsts = [
+        str(tconst) for tconst in np.load(os.path.join(base_dir, "tconsts.npy"))
+    ]
+    old_hashes = np.load(os.path.join(base_dir, "entry_hashes.npy"))
+    old_index = {tconst: i for i, tconst in enumerate(old_tconsts)}
+    hashes = {tconst: _hash_entry(entry) for tconst, entry in wikipedia.items()}
+
+    # Work out which movies are new, changed, and removed
+    tconsts = [tconst for tconst in old_tconsts if tconst in wikipedia]
+    tconsts += [tconst for tconst in wikipedia if tconst not in old_index]
+    is_updated = np.array(
+        [
+            tconst not in old_index or hashes[tconst] != old_hashes[old_index[tconst]]
+            for tconst in tconsts
+        ],
+        dtype=bool,
+    )
+    updated = [tconst for tconst, flag in zip(tconsts, is_updated) if flag]
+    stale = [
+        i for i, tconst in enumerate(old_tconsts) if hashes.get(tconst) != old_hashes[i]
+    ]
+    # Scores between unchanged movies keep the IDF weights they were computed with (see
+    # _update_neighbour_table), so count every change since the last full build
+    base_update = {"full_build": os.path.basename(base_dir), "drift": 0}
+    if os.path.exists(os.path.join(base_dir, "update.json")):
+        with open(os.path.join(base_dir, "update.json")) as f:
+            base_update = json.load(f)
+    drift = base_update["drift"] + max(len(updated), len(stale))
+    if drift > MAX_INCREMENTAL_CHANGE * len(tconsts):
+        return False
+
+    # Preprocess and count just the new and changed entries (if movies were only removed,
+    # there is nothing to count, and the vectorizer can't transform an empty list)
+    if updated:
+        with open(os.path.join(base_dir, "vectorizer.p"), "rb") as f:
+            vectorizer = pickle.load(f)
+        preprocessed = _preprocess_wikipedia(
+            {tconst: wikipedia[tconst] for tconst in updated}
+        )
+        updated_counts = vectorizer.transform([preprocessed[t] for t in updated])
+        updated_counts = updated_counts.tocsr()
+    else:
+        updated_counts = scipy.sparse.csr_matrix((0, HASHING_FEATURES), dtype=np.int64)
+
+    # Reuse the counts of unchanged movies, and swap the document frequencies of changed and
+    # removed entries for those of the new and changed ones
+    old_counts = scipy.sparse.load_npz(os.path.join(base_dir, "counts.npz")).tocsr()
+    df = np.load(os.path.join(base_dir, "df.npy"))
+    df -= np.bincount(old_counts[stale].indices, minlength=len(df))
+    df += np.bincount(updated_counts.indices, minlength=len(df))
+
+    unchanged_rows = [old_index[t] for t, flag in zip(tconsts, is_updated) if not flag]
+    counts = scipy.sparse.vstack([old_counts[unchanged_rows], updated_counts]).tocsr()
+    # Stacked rows are unchanged movies then updated ones, so put them back in order
+    order = np.empty(len(tconsts), dtype=np.int64)
+    order[~is_updated] = np.arange(len(unchanged_rows))
+    order[is_updated] = np.arange(len(updated)) + len(unchanged_rows)
+    counts = counts[order]
+    tfidf = _hashed_tfidf(counts, df)
+
+    # Write everything to a temporary directory first (see _get_model_artifacts)
+    tmp_dir = _make_tmp_dir(artifact_dir)
+    shutil.copy(os.path.join(base_dir, "vectorizer.p"), tmp_dir)
+    scipy.sparse.save_npz(os.path.join(tmp_dir, "counts.npz"), counts)
+    np.save(os.path.join(tmp_dir, "df.npy"), df)
+    np.save(os.path.join(tmp_dir, "entry_hashes.npy"), [hashes[t] for t in tconsts])
+    scipy.sparse.save_npz(os.path.join(tmp_dir, "tfidf.npz"), tfidf)
+    np.save(os.path.join(tmp_dir, "tconsts.npy"), np.array(tconsts))
+    changed = sum(tconst in old_index for tconst in updated)
+    with open(os.path.join(tmp_dir, "update.json"), "w") as f:
+        json.dump(
+            {
+                "base": os.path.basename(base_dir),
+                "added": len(updated) - changed,
+                "changed": changed,
+                "removed": sum(tconst not in wikipedia for tconst in old_tconsts),
+                "full_build": base_update["full_build"],
+                "drift": drift,
+            },
+            f,
+        )
+
+    # Update every neighbour table of the previous build
+    new_index = {tconst: i for i, tconst in enumerate(tconsts)}
+    old_to_new = np.array(
+        [
+            (
+                new_index[tconst]
+                if tconst in new_index and not is_updated[new_index[tconst]]
+                else -1
+            )
+            for tconst in old_tconsts
+        ],
+        dtype=np.int32,
+    )
+    for name in os.listdir(base_dir):
+        if name.startswith("neighbours-") and not name.endswith(".tmp"):
+            _update_neighbour_table(
+                os.path.join(base_dir, name),
+                os.path.join(tmp_dir, name),
+                tfidf,
+                old_to_new,
+                np.flatnonzero(is_updated),
+            )
+
+    _move_into_place(tmp_dir, artifact_dir)
+    return True
+
+
+# Returns a stable hash of the contents of a Wikipedia dataset
+def _hash_wikipedia(wikipedia):
+    digest = hashlib.sha256()
+    for tconst in sorted(wikipedia):
+        digest.update(tconst.encode())
+        digest.update(b"\0")
+        digest.update(wikipedia[tconst].encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+# Returns a short hash of some JSON-serializable parts, used to key cached artifacts
+def _hash_key(*parts):
+    encoded = json.dumps(parts, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+# Creates an empty temporary directory next to out_dir to build it in. Every call gets a
+# directory of its own, so processes that build the same artifacts at once (e.g. several
+# server processes starting on a new dataset) never delete each other's work. It is made
+# readable by everyone like a regular directory, since it ends up shared by the servers.
+def _make_tmp_dir(out_dir):
+    tmp_dir = tempfile.mkdtemp(
+        prefix=f"{os.path.basename(out_dir)}.",
+        suffix=".tmp",
+        dir=os.path.dirname(out_dir),
+    )
+    os.chmod(tmp_dir, 0o755)
+    return tmp_dir
+
+
+# Moves a directory built by _make_tmp_dir into place at out_dir. If another process has
+# put its own copy there in the meantime, that one is kept and ours is discarded.
+def _move_into_place(tmp_dir, out_dir):
+    try:
+        os.replace(tmp_dir, out_dir)
+    except OSError:
+        if not os.path.isdir(out_dir):
+            raise
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# Returns the directory that stores the top-k neighbour table of an artifact directory
+def _neighbours_dir(artifact_dir, k):
+    return os.path.join(artifact_dir, f"neighbours-{k}")
+
+
+# Computes the top-k neighbours of every movie in row blocks across a process pool,
+# so that the full n x n matrix M never materialises, and writes them to the model's
+# artifact directory as:
+# - neighbour_idxs.npy: n x k int32 matrix of neighbour indices, sorted by descending score
+# - neighbour_scores.npy: n x k float32 matrix of the corresponding similarity scores
+# Movies with fewer than k non-zero neighbours are padded with index -1 and score 0.
+# k defaults to the current value of NEIGHBOURS_K.
+def build_neighbour_table(wikipedia, k=None, block_size=NEIGHBOURS_BLOCK_SIZE):
+    k = NEIGHBOURS_K if k is None else k
+    artifact_dir = _get_model_artifacts(wikipedia)
+    out_dir = _neighbours_dir(artifact_dir, k)
+    tfidf = _load_similarity_model(artifact_dir, "sparse")["tfidf"]
+    n = tfidf.shape[0]
+    k = max(0, min(k, n - 1))
+
+    # Write everything to a temporary directory first, so that readers never see
+    # a partially built table
+    tmp_dir = _make_tmp_dir(out_dir)
+    neighbour_idxs = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, "neighbour_idxs.npy"), "w+", np.int32, (n, k)
+    )
+    neighbour_scores = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, "neighbour_scores.npy"), "w+", np.float32, (n, k)
+    )
+
+    # Compute blocks of rows in parallel, and copy them into the table as they finish
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+    pool = Pool(
+        processes=cpu_count(),
+        initializer=_init_neighbour_worker,
+        initargs=(tfidf, k),
+    )
+    for start, end, idxs, scores in pool.imap_unordered(_neighbour_block, blocks):
+        neighbour_idxs[start:end] = idxs
+        neighbour_scores[start:end] = scores
     pool.close()
+    pool.join()
+
+    neighbour_idxs.flush()
+    neighbour_scores.flush()
+    del neighbour_idxs, neighbour_scores
+
+    # Swap the finished table into place
+    _move_into_place(tmp_dir, out_dir)
+
+
+# Loads a neighbour table written by build_neighbour_table. The (large) neighbour
+# matrices are memory-mapped rather than read, so startup is close to instant and
+# several server processes share the same pages through the OS page cache
+def _load_neighbour_table(artifact_dir, out_dir):
+    return {
+        "mode": "topk",
+        "version": os.path.basename(artifact_dir),
+        "tconst_map": _load_tconst_map(artifact_dir),
+        "neighbour_idxs": np.load(
+            os.path.join(out_dir, "neighbour_idxs.npy"), mmap_mode="r"
+        ),
+        "neighbour_scores": np.load(
+            os.path.join(out_dir, "neighbour_scores.npy"), mmap_mode="r"
+        ),
+    }
+
+
+# Stores the TF-IDF matrix in each neighbour table worker, so it is only sent once per worker
+def _init_neighbour_worker(tfidf, k):
+    global _worker_tfidf, _worker_k
+    _worker_tfidf, _worker_k = tfidf, k
+
+
+# Computes the top-k neighbours for rows [start, end) of M
+def _neighbour_block(block):
+    start, end = block
+    tfidf, k = _worker_tfidf, _worker_k
+
+    # Compute this block of rows of M, and make sure a movie is never its own neighbour
+    similarity = (tfidf[start:end] @ tfidf.T).toarray().astype(np.float32)
+    rows = np.arange(end - start)
+    similarity[rows, rows + start] = -1
+
+    idxs, scores = _select_neighbours(similarity, np.arange(tfidf.shape[0]), k)
+    return start, end, idxs, scores
+
+
+# Selects the k largest scores of each row of a block of candidate scores, where candidate
+# j of a row is movie idxs[j] (or idxs[row, j] if idxs is 2-d). Returns the selected
+# (neighbour indices, scores) sorted by descending score, padded like the neighbour table.
+def _select_neighbours(scores, idxs, k):
+    idxs = np.broadcast_to(idxs, scores.shape)
+    if k == 0:
+        return np.empty((len(scores), 0), np.int32), np.empty(
+            (len(scores), 0), np.float32
+        )
+
+    # Select the k largest scores per row, then sort just those
+    selected = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(scores, selected, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    selected = np.take_along_axis(selected, order, axis=1)
+    idxs = np.take_along_axis(idxs, selected, axis=1).astype(np.int32)
+    scores = np.take_along_axis(scores, order, axis=1).astype(np.float32)
+
+    # Pad out anything that isn't actually similar
+    empty = scores <= 0
+    idxs[empty] = -1
+    scores[empty] = 0
+
+    return idxs, scores
+
+
+# Returns the directory that stores an ANN index with the given parameters (see ANN_PARAMS)
+# of an artifact directory
+def _ann_dir(artifact_dir, params):
+    return os.path.join(artifact_dir, f"ann-{_hash_key(params)}")
+
+
+# Builds an IVF index (see ANN_PARAMS) over the TF-IDF matrix X of an artifact directory,
+# and writes it to the artifact directory as:
+# - nearest.npy: n x max_probes int32 matrix of the lists nearest to each movie, nearest first
+# - order.npy: the indices of the movies, sorted by the list they're in (their nearest one)
+# - offsets.npy: where each list starts in order.npy, plus the total number of movies
+# Since queries are always movies in the index, their nearest lists are worked out up front,
+# and neither the projection nor the centroids are needed at query time.
+def _build_ann_index(artifact_dir, params, block_size=4096):
+    out_dir = _ann_dir(artifact_dir, params)
+    tfidf = scipy.sparse.load_npz(os.path.join(artifact_dir, "tfidf.npz")).tocsr()
+    n = tfidf.shape[0]
+    sample_size = min(n, params["sample"])
+    n_lists = max(1, min(params["lists"] or int(4 * np.sqrt(n)), sample_size))
+    max_probes = min(params["max_probes"], n_lists)
+    rng = np.random.default_rng(params["seed"])
+
+    # Project X down to a few dimensions, which roughly preserves cosine similarities
+    projection = SparseRandomProjection(
+        params["dimensions"], dense_output=True, random_state=params["seed"]
+    ).fit(tfidf)
+    reduced = np.vstack(
+        [
+            normalize(projection.transform(tfidf[start : start + block_size]))
+            for start in range(0, n, block_size)
+        ]
+    ).astype(np.float32)
+
+    # Train the centroids of the lists with spherical k-means on a sample of the movies
+    sample = reduced[rng.choice(n, sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+    for _ in range(params["iterations"]):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        members = scipy.sparse.csr_matrix(
+            (np.ones(sample_size, np.float32), (assignment, np.arange(sample_size))),
+            shape=(n_lists, sample_size),
+        )
+        sums = members @ sample
+        norms = np.linalg.norm(sums, axis=1)
+        # Lists that lost all of their movies keep their old centroid
+        centroids[norms > 0] = sums[norms > 0] / norms[norms > 0, None]
+
+    # Find the nearest lists of every movie, and put each movie in its nearest list
+    nearest = np.empty((n, max_probes), dtype=np.int32)
+    for start in range(0, n, block_size):
+        scores = reduced[start : start + block_size] @ centroids.T
+        top = np.argpartition(-scores, max_probes - 1, axis=1)[:, :max_probes]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        nearest[start : start + block_size] = np.take_along_axis(top, order, axis=1)
+    order = np.argsort(nearest[:, 0], kind="stable").astype(np.int32)
+    offsets = np.searchsorted(nearest[order, 0], np.arange(n_lists + 1))
+
+    # Write everything to a temporary directory first (see build_neighbour_table)
+    tmp_dir = _make_tmp_dir(out_dir)
+    np.save(os.path.join(tmp_dir, "nearest.npy"), nearest)
+    np.save(os.path.join(tmp_dir, "order.npy"), order)
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+    _move_into_place(tmp_dir, out_dir)
+
+
+# Loads an ANN index written by _build_ann_index, memory-mapping its matrices
+def _load_ann_index(ann_dir):
+    ann = {
+        name: np.load(os.path.join(ann_dir, f"{name}.npy"), mmap_mode="r")
+        for name in ("nearest", "order", "offsets")
+    }
+    ann["probes"] = ANN_PROBES
+    return ann
+
+
+# Returns the indices of the candidate neighbours of movie i in an ANN index: every other
+# movie in the ann["probes"] lists nearest to it
+def _ann_candidates(ann, i):
+    offsets, order = ann["offsets"], ann["order"]
+    candidates = np.concatenate(
+        [order[offsets[j] : offsets[j + 1]] for j in ann["nearest"][i][: ann["probes"]]]
+    )
+    return candidates[candidates != i]
+
+
+# Returns the directory that stores LSA embeddings with the given parameters (see LSA_PARAMS)
+# of an artifact directory
+def _lsa_dir(artifact_dir, params):
+    return os.path.join(artifact_dir, f"lsa-{_hash_key(params)}")
+
+
+# Embeds the movies of an artifact directory with a truncated SVD of their TF-IDF matrix X
+# (see LSA_PARAMS), and writes them to the artifact directory as:
+# - embeddings.npy: n x d matrix E of L2-normalised embeddings, as float32 or int8
+# - scales.npy: (int8 only) the scale of each row of E, so row i is embeddings[i] * scales[i]
+# - quality.json: how closely E E^T matches X X^T on a sample of movies (see _quality_delta)
+def _build_lsa_embeddings(artifact_dir, params, n_queries=100, k=20):
+    out_dir = _lsa_dir(artifact_dir, params)
+    tfidf = scipy.sparse.load_npz(os.path.join(artifact_dir, "tfidf.npz")).tocsr()
+    components = max(1, min(params["components"], min(tfidf.shape) - 1))
+
+    svd = TruncatedSVD(components, random_state=params["seed"])
+    embeddings = normalize(svd.fit_transform(tfidf)).astype(np.float32)
+
+    # Quantise each row to int8 with its own scale
+    scales = None
+    if params["dtype"] == "int8":
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+        embeddings = np.round(embeddings / scales[:, None]).astype(np.int8)
+        scales = scales.astype(np.float32)
+    elif params["dtype"] != "float32":
+        raise ValueError(f"Unknown LSA dtype: {params['dtype']}")
+
+    lsa = {"embeddings": embeddings, "scales": scales}
+    quality = _quality_delta(
+        {"mode": "sparse", "tfidf": tfidf, "tconst_map": range(tfidf.shape[0])},
+        {"mode": "lsa", "lsa": lsa},
+        n_queries,
+        k,
+    )
 
-    return wikipedia
+    # Write everything to a temporary directory first (see build_neighbour_table)
+    tmp_dir = _make_tmp_dir(out_dir)
+    np.save(os.path.join(tmp_dir, "embeddings.npy"), embeddings)
+    if scales is not None:
+        np.save(os.path.join(tmp_dir, "scales.npy"), scales)
+    with open(os.path.join(tmp_dir, "quality.json"), "w") as f:
+        json.dump(quality, f)
+    _move_into_place(tmp_dir, out_dir)
+
+
+# Loads LSA embeddings written by _build_lsa_embeddings
+def _load_lsa_embeddings(lsa_dir):
+    scales_file = os.path.join(lsa_dir, "scales.npy")
+    return {
+        "embeddings": np.load(os.path.join(lsa_dir, "embeddings.npy")),
+        "scales": np.load(scales_file) if os.path.exists(scales_file) else None,
+    }
+
+
+# Returns the cosine similarities between the embeddings of movies idxs and every movie,
+# as a len(idxs) x n matrix. int8 embeddings are converted back to float32 a block of rows
+# at a time, so every block is still a single BLAS mat-mul.
+def _lsa_scores(lsa, idxs, block_size=65536):
+    embeddings, scales = lsa["embeddings"], lsa["scales"]
+    if scales is None:
+        return embeddings[idxs] @ embeddings.T
+
+    queries = embeddings[idxs].astype(np.float32) * scales[idxs, None]
+    scores = np.empty((len(idxs), len(embeddings)), dtype=np.float32)
+    for start in range(0, len(embeddings), block_size):
+        block = embeddings[start : start + block_size].astype(np.float32)
+        scores[:, start : start + block_size] = (queries @ block.T) * scales[
+            start : start + block_size
+        ]
+    return scores
+
+
+# Compares the top k movies of a model against those of a reference model for a sample of
+# n_queries movies. Returns the mean recall@k of the model's top k against the reference
+# top k, and the mean absolute difference between their scores for the reference top k.
+def _quality_delta(reference, model, n_queries=100, k=20):
+    n = len(reference["tconst_map"])
+    rng = np.random.default_rng(0)
+    queries = rng.choice(n, size=min(n_queries, n), replace=False)
+
+    recalls, errors = [], []
+    for i in queries:
+        expected_scores = _similarity_row(reference, i)
+        expected = _top_k(expected_scores, k, exclude=i)
+        if len(expected) == 0:
+            continue
+        scores = _similarity_row(model, i)
+        recalls.append(
+            len(np.intersect1d(_top_k(scores, k, exclude=i), expected)) / len(expected)
+        )
+        errors.append(np.abs(scores[expected] - expected_scores[expected]).mean())
+
+    return {
+        "k": k,
+        "recall": float(np.mean(recalls)) if recalls else None,
+        "score_error": float(np.mean(errors)) if errors else None,
+    }
+
+
+# Reports how well the "ann" mode approximates the exact ("sparse") similarity scores for a
+# sample of n_queries movies: the mean recall@k of its top k movies against the exact top k,
+# the mean number of candidates scored per query, and the mean latency per query, for each
+# number of probes. Use this to pick ANN_PARAMS and ANN_PROBES for a corpus.
+def benchmark_ann(wikipedia, k=20, n_queries=100, probes=(1, 2, 4, 8, 16, 32)):
+    exact = _build_similarity_model(wikipedia, "sparse")
+    approx = _build_similarity_model(wikipedia, "ann")
+    n = len(exact["tconst_map"])
+    rng = np.random.default_rng(0)
+    queries = rng.choice(n, size=min(n_queries, n), replace=False)
+
+    def run(model, i):
+        start = time.perf_counter()
+        neighbours = _top_k(_similarity_row(model, i), k, exclude=i)
+        return neighbours, time.perf_counter() - start
+
+    truth, latencies = zip(*(run(exact, i) for i in queries))
+    print(f"exact: {np.mean(latencies) * 1000:.2f} ms/query")
+
+    results = {}
+    for n_probes in probes:
+        approx["ann"]["probes"] = min(n_probes, approx["ann"]["nearest"].shape[1])
+        recalls, latencies, candidates = [], [], []
+        for i, expected in zip(queries, truth):
+            neighbours, latency = run(approx, i)
+            if len(expected) > 0:
+                recalls.append(
+                    len(np.intersect1d(neighbours, expected)) / len(expected)
+                )
+            latencies.append(latency)
+            candidates.append(len(_ann_candidates(approx["ann"], i)))
+
+        results[n_probes] = {
+            "recall": float(np.mean(recalls)) if recalls else None,
+            "candidates": float(np.mean(candidates)),
+            "mean_ms": float(np.mean(latencies) * 1000),
+        }
+        print(
+            f"probes={n_probes}: recall@{k} {results[n_probes]['recall']:.3f}, "
+            f"{results[n_probes]['candidates']:8.0f} candidates, "
+            f"{results[n_probes]['mean_ms']:7.2f} ms/query"
+        )
+
+    return results
+
+
+# Writes an updated copy of the neighbour table in base_out_dir to out_dir, given the new
+# TF-IDF matrix, a map from old to new movie indices (-1 for movies that were removed or
+# changed), and the new indices of the new and changed ("updated") movies:
+# - rows of updated movies are recomputed from scratch
+# - rows of other movies keep their old neighbours (minus removed or changed movies), and
+#   merge in their similarity to every updated movie
+# Scores between two unchanged movies are not recomputed, so they keep the IDF weights of
+# the build they were computed in until the table is next built from scratch (see
+# MAX_INCREMENTAL_CHANGE). A row that lost neighbours can also miss movies that were just
+# outside of its top k.
+def _update_neighbour_table(
+    base_out_dir, out_dir, tfidf, old_to_new, updated, block_size=NEIGHBOURS_BLOCK_SIZE
+):
+    old_idxs = np.load(os.path.join(base_out_dir, "neighbour_idxs.npy"), mmap_mode="r")
+    old_scores = np.load(
+        os.path.join(base_out_dir, "neighbour_scores.npy"), mmap_mode="r"
+    )
+    n, k = tfidf.shape[0], old_idxs.shape[1]
+    if k > n - 1:
+        # Not enough movies left for a table this wide, so leave it to be rebuilt
+        return
+
+    os.makedirs(out_dir)
+    neighbour_idxs = np.lib.format.open_memmap(
+        os.path.join(out_dir, "neighbour_idxs.npy"), "w+", np.int32, (n, k)
+    )
+    neighbour_scores = np.lib.format.open_memmap(
+        os.path.join(out_dir, "neighbour_scores.npy"), "w+", np.float32, (n, k)
+    )
+
+    # Recompute the rows of updated movies
+    for start in range(0, len(updated), block_size):
+        rows = updated[start : start + block_size]
+        similarity = (tfidf[rows] @ tfidf.T).toarray().astype(np.float32)
+        similarity[np.arange(len(rows)), rows] = -1
+        idxs, scores = _select_neighbours(similarity, np.arange(n), k)
+        neighbour_idxs[rows], neighbour_scores[rows] = idxs, scores
+
+    # Merge the updated movies into the old rows of every other movie. Appending -1 to
+    # old_to_new maps the old padding (index -1) to -1 as well.
+    old_to_new = np.append(old_to_new, -1)
+    updated_tfidf = tfidf[updated].T.tocsc()
+    old_rows = np.flatnonzero(old_to_new[:-1] >= 0)
+    for start in range(0, len(old_rows), block_size):
+        rows = old_rows[start : start + block_size]
+        new_rows = old_to_new[rows]
+        kept_idxs = old_to_new[old_idxs[rows]]
+        kept_scores = np.where(kept_idxs >= 0, old_scores[rows], -1)
+        similarity = (tfidf[new_rows] @ updated_tfidf).toarray().astype(np.float32)
+        idxs, scores = _select_neighbours(
+            np.hstack([kept_scores, similarity]),
+            np.hstack([kept_idxs, np.broadcast_to(updated, similarity.shape)]),
+            k,
+        )
+        neighbour_idxs[new_rows], neighbour_scores[new_rows] = idxs, scores
+
+    neighbour_idxs.flush()
+    neighbour_scores.flush()
+
+
+# Preprocess the entire Wikipedia dataset in parallel
+def _preprocess_wikipedia(wikipedia, tokenizer=None):
+    tokenizer = tokenizer or PREPROCESS_PARAMS["tokenizer"]
+
+    # Parallel map the entry parser to generate a new, cleaned dataset. Each worker loads the
+    # stopwords once, and entries are streamed to the workers in chunks as they free up.
+    with Pool(
+        processes=cpu_count(),
+        initializer=_init_preprocess_worker,
+        initargs=(tokenizer,),
+    ) as pool:
+        preprocessed = dict(
+            pool.imap_unordered(
+                _preprocess_wikipedia_entry,
+                wikipedia.items(),
+                chunksize=PREPROCESS_CHUNK_SIZE,
+            )
+        )
+
+    # Restore the original order, so the model doesn't depend on worker scheduling
+    return {tconst: preprocessed[tconst] for tconst in wikipedia}
+
+
+# Loads the resources used to preprocess entries once per worker process
+def _init_preprocess_worker(tokenizer):
+    global _worker_tokenize, _worker_stopwords
+    _worker_tokenize = word_tokenize if tokenizer == "nltk" else _fast_tokenize
+    _worker_stopwords = set(stopwords.words("english"))
 
 
 # Preprocess the contents of a single Wikipedia entry
 def _preprocess_wikipedia_entry(item):
     tconst, entry = item
+    return tconst, _preprocess_entry(entry, _worker_tokenize, _worker_stopwords)
+
 
+# Regular expressions used to clean up entries before they are tokenized
+_CITATION_RE = re.compile(r"\[[0-9]+\]")
+_NON_ASCII_RE = re.compile(r"[^\x00-\x7F]+")
+
+
+# Preprocess the text of a Wikipedia entry, given a tokenizer and a set of stopwords
+def _preprocess_entry(entry, tokenize, stopwords_set):
     # Replace newlines with spaces
     entry = entry.replace("\n", " ")
     # Replace citations with spaces
-    entry = re.sub("\[[0-9]+\]", " ", entry)
+    entry = _CITATION_RE.sub(" ", entry)
     # Replace non-ASCII characters with nothing
-    entry = re.sub(r"[^\x00-\x7F]+", "", entry)
+    entry = _NON_ASCII_RE.sub("", entry)
     # Strip entry
     entry = entry.strip()
 
     # Tokenize and remove punctuation + stop words
-    stopwords_set = set(stopwords.words("english"))
-    entry = word_tokenize(entry)
+    entry = tokenize(entry)
     entry = list(
         filter(
             lambda token: "'" not in token
@@ -127,6 +1320,190 @@ def _preprocess_wikipedia_entry(item):
     # entry = [stemmer.stem(word) for word in entry]
 
     # Rejoin entry
-    entry = " ".join(entry)
+    return " ".join(entry)
+
 
-    return tconst, entry
+# Substitutions of the fast tokenizer, in order. These follow the rules of NLTK's
+# NLTKWordTokenizer for ASCII text, except that sentence-final periods are split off wherever
+# a period ends a word (other than an initial) instead of running the Punkt sentence splitter.
+# Tokens containing quotes or periods are dropped by _preprocess_entry anyway, so we only need
+# to split off what would otherwise be glued onto the words we keep.
+_FAST_TOKENIZER_RULES = [
+    # Sentence-final periods, and ellipses
+    (re.compile(r"(?<![\s.])(?<!\b\w)\.(?=[\]\)}>\"']*(?:\s|$))"), " . "),
+    (re.compile(r"\.{2,}"), r" \g<0> "),
+    # Punctuation, brackets, double quotes, backticks, double dashes, and colons and commas
+    # (unless they're inside a number)
+    (re.compile(r"[;@#$%&?!*\[\](){}<>\"]|`+|''|--|[:,](?!\d)"), r" \g<0> "),
+    # Opening single quotes, and clitics ('s, n't, etc.) or closing single quotes
+    (re.compile(r"(?i)(?<!\w)'(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)"), "' "),
+    (
+        re.compile(r"(?<=[^'\s])('[sSmMdD]|'ll|'LL|'re|'RE|'ve|'VE|n't|N'T|')(?=\s|$)"),
+        r" \1 ",
+    ),
+    # Contractions ("cannot" -> "can not", "gonna" -> "gon na", "'tis" -> "'t is", etc.)
+    (
+        re.compile(
+            r"(?i)\b(?:can(?=not\b)|d(?='ye\b)|gim(?=me\b)|lem(?=me\b)|gon(?=na\b)"
+            r"|got(?=ta\b)|more(?='n\b)|wan(?=na\s))|(?<=\s)'t(?=(?:is|was)\b)"
+        ),
+        r"\g<0> ",
+    ),
+]
+
+
+# Tokenizes text like word_tokenize, for the tokens that _preprocess_entry keeps
+def _fast_tokenize(text):
+    for regexp, substitution in _FAST_TOKENIZER_RULES:
+        text = regexp.sub(substitution, text)
+    return text.split()
+
+
+# Compares the fast tokenizer against word_tokenize on (a sample of n_entries entries of)
+# a Wikipedia dataset, after the rest of the preprocessing. Returns the fraction of entries
+# that preprocess to exactly the same text, and the fraction of tokens the two agree on.
+def validate_fast_tokenizer(wikipedia, n_entries=None):
+    stopwords_set = set(stopwords.words("english"))
+    entries = list(wikipedia.values())[:n_entries]
+
+    identical, shared, total = 0, 0, 0
+    for entry in entries:
+        expected = _preprocess_entry(entry, word_tokenize, stopwords_set).split()
+        actual = _preprocess_entry(entry, _fast_tokenize, stopwords_set).split()
+        identical += expected == actual
+        counts = {}
+        for token in expected:
+            counts[token] = counts.get(token, 0) + 1
+        for token in actual:
+            if counts.get(token, 0) > 0:
+                counts[token] -= 1
+                shared += 1
+        total += max(len(expected), len(actual))
+
+    return {
+        "identical": identical / max(len(entries), 1),
+        "tokens": shared / max(total, 1),
+    }
+
+
+# Times preprocessing of a Wikipedia dataset with each tokenizer, and reports the throughput
+# of each alongside how closely the fast tokenizer matches word_tokenize
+def benchmark_preprocessing(wikipedia, tokenizers=("nltk", "regex")):
+    for tokenizer in tokenizers:
+        start = time.perf_counter()
+        _preprocess_wikipedia(wikipedia, tokenizer)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{tokenizer:>6}: {len(wikipedia)} entries in {elapsed:.1f}s "
+            f"({len(wikipedia) / elapsed:.0f} docs/sec)"
+        )
+
+    agreement = validate_fast_tokenizer(wikipedia)
+    print(
+        f"regex vs nltk: {agreement['identical']:.2%} of entries identical, "
+        f"{agreement['tokens']:.2%} of tokens shared"
+    )
+
+
+# Updates a model of the first n movies of a Wikipedia dataset with hashed features in a
+# temporary model cache, with just n_changes movies removed, then added, then changed, and
+# then with nothing changed at all. Checks that each update is applied incrementally with
+# the right counts, and gives the same TF-IDF matrix as a build from scratch.
+def run_update_test(wikipedia, n_movies=500, n_changes=5):
+    global FEATURES, MODEL_CACHE_DIR
+
+    tconsts = list(wikipedia)
+    assert len(tconsts) >= n_movies + n_changes, "Not enough movies"
+    base = {tconst: wikipedia[tconst] for tconst in tconsts[:n_movies]}
+    removed = {tconst: base[tconst] for tconst in tconsts[n_changes:n_movies]}
+    added = dict(removed)
+    for tconst in tconsts[n_movies : n_movies + n_changes]:
+        added[tconst] = wikipedia[tconst]
+    changed = dict(added)
+    for tconst in tconsts[n_changes : 2 * n_changes]:
+        changed[tconst] += " sequel"
+    cases = [
+        ("removed", removed, {"added": 0, "changed": 0, "removed": n_changes}),
+        ("added", added, {"added": n_changes, "changed": 0, "removed": 0}),
+        ("changed", changed, {"added": 0, "changed": n_changes, "removed": 0}),
+        ("no-op", changed, None),
+    ]
+
+    features, cache_dir = FEATURES, MODEL_CACHE_DIR
+    FEATURES = "hashing"
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            MODEL_CACHE_DIR = os.path.join(tmp, "incremental")
+            init_model(base, "topk")
+            for name, dataset, expected in cases:
+                version = _model["version"]
+                start = time.time()
+                changes = update_model(dataset, "topk")
+                print(f"{name}: {(time.time() - start):.2f}s, {changes}")
+                assert len(_model["tconst_map"]) == len(dataset), name
+                assert _model["neighbour_idxs"].shape[0] == len(dataset), name
+                if expected is None:
+                    assert _model["version"] == version, f"{name} rebuilt the model"
+                    continue
+                assert changes is not None, f"{name} was built from scratch"
+                assert {key: changes[key] for key in expected} == expected, name
+
+                # Compare the TF-IDF matrix with one built from scratch, row by row
+                update_dir = os.path.join(MODEL_CACHE_DIR, _model["version"])
+                MODEL_CACHE_DIR = os.path.join(tmp, name)
+                full_dir = _get_model_artifacts(dataset)
+                MODEL_CACHE_DIR = os.path.dirname(update_dir)
+                update_map = _load_tconst_map(update_dir)
+                full_map = _load_tconst_map(full_dir)
+                order = [update_map[full_map.inverse[i]] for i in range(len(full_map))]
+                update_tfidf = scipy.sparse.load_npz(
+                    os.path.join(update_dir, "tfidf.npz")
+                )
+                full_tfidf = scipy.sparse.load_npz(os.path.join(full_dir, "tfidf.npz"))
+                error = abs(update_tfidf[order] - full_tfidf).max()
+                assert error < 1e-9, f"{name}: TF-IDF differs by {error}"
+    finally:
+        FEATURES, MODEL_CACHE_DIR = features, cache_dir
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    # Offline model tools
+    # Usage:
+    # - python model.py build [path to wikipedia.p]: build the top-K neighbour table
+    # - python model.py benchmark [path to wikipedia.p]: compare the similarity modes
+    # - python model.py preprocess [path to wikipedia.p]: compare the preprocessing tokenizers
+    # - python model.py ann [path to wikipedia.p]: report recall@k and latency of the "ann" mode
+    # - python model.py update [path to wikipedia.p]: update the model (and neighbour
+    #   table) for a changed dataset, incrementally if FEATURES = "hashing"
+    # - python model.py test-update [path to wikipedia.p]: check incremental updates that
+    #   only remove, add, or change movies, or change nothing (see run_update_test)
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "benchmark"
+    with open(sys.argv[2] if len(sys.argv) > 2 else "wikipedia.p", "rb") as f:
+        wikipedia = pickle.load(f)
+
+    if command == "build":
+        start = time.time()
+        print("Building neighbour table...", end=" ", flush=True)
+        build_neighbour_table(wikipedia)
+        print(f"Done [{(time.time() - start):.1f}s]")
+    elif command == "benchmark":
+        benchmark_similarity_modes(wikipedia)
+    elif command == "preprocess":
+        benchmark_preprocessing(wikipedia)
+    elif command == "ann":
+        benchmark_ann(wikipedia)
+    elif command == "update":
+        start = time.time()
+        print("Updating model...", end=" ", flush=True)
+        changes = update_model(wikipedia, "topk")
+        print(f"Done [{(time.time() - start):.1f}s]")
+        print(changes or "Built from scratch")
+    elif command == "test-update":
+        run_update_test(wikipedia)
+    else:
+        print(f"Unknown command: {command}")
+        exit(1)
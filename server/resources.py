@@ -0,0 +1,92 @@
+import os, sqlite3, pickle, queue, threading, pathlib
+from contextlib import contextmanager
+
+# Process-wide data handles shared by every request, so that per-request
+# overhead is just borrowing a connection from a pool.
+
+
+# Pragmas applied to every read-only IMDB connection
+SQLITE_PRAGMAS = {
+    "query_only": 1,
+    # Memory-map up to 1 GB of the database, so reads are served from the OS page cache
+    "mmap_size": 1 << 30,
+    # Page cache per connection, in KiB when negative (64 MiB)
+    "cache_size": -(1 << 16),
+    "temp_store": "MEMORY",
+}
+
+
+# A bounded pool of read-only Sqlite3 connections to a single database.
+# Connections are opened lazily, up to size of them, and borrowing blocks
+# while all of them are in use.
+class ConnectionPool:
+    def __init__(self, path, size=8):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._available = threading.Semaphore(size)
+        # Connections opened before the last reset() are closed instead of reused
+        self._generation = 0
+
+    # Borrows a connection from the pool for the duration of a with block
+    @contextmanager
+    def connection(self):
+        self._available.acquire()
+        try:
+            try:
+                generation, conn = self._idle.get_nowait()
+            except queue.Empty:
+                generation, conn = self._generation, self._connect()
+            try:
+                yield conn
+            finally:
+                if generation == self._generation:
+                    self._idle.put((generation, conn))
+                else:
+                    conn.close()
+        finally:
+            self._available.release()
+
+    # Closes every idle connection in the pool
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait()[1].close()
+            except queue.Empty:
+                break
+
+    # Closes every connection in the pool, e.g. after the database file has been replaced.
+    # Connections that are in use are closed once they are returned.
+    def reset(self):
+        self._generation += 1
+        self.close()
+
+    # Opens a new read-only connection with our tuned pragmas
+    def _connect(self):
+        uri = f"{pathlib.Path(self.path).resolve().as_uri()}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        for pragma, value in SQLITE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma}={value}")
+        return conn
+
+
+# Returns a value that changes whenever the file at path is modified or replaced
+def file_version(path):
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+# Lazily loads a pickled file once per process, and returns the same object afterwards
+class SharedPickle:
+    def __init__(self, path):
+        self.path = path
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    with open(self.path, "rb") as f:
+                        self._value = pickle.load(f)
+        return self._value